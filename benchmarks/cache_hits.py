@@ -0,0 +1,60 @@
+"""
+Measures how many cache hits per second can be served with different numbers of threads
+
+Run from the root of the repository using: python -m benchmarks.cache_hits
+"""
+
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from tempfile import TemporaryDirectory
+
+from conan_inquiry.util.cache import Cache
+
+CONTEXTS = ['github_raw', 'bintray', 'boost_docs', 'rendered_readme']
+KEYS_PER_CONTEXT = 500
+LOOKUPS = 200000
+
+
+def _lookups(cache, count, seed):
+    rand = random.Random(seed)
+    for _ in range(count):
+        context = rand.choice(CONTEXTS)
+        key = str(rand.randrange(KEYS_PER_CONTEXT))
+        if cache.get(key, timedelta(days=1), context) is None:
+            raise RuntimeError('Unexpected cache miss for {}/{}'.format(context, key))
+
+
+def run(threads):
+    with TemporaryDirectory() as dir:
+        cache = Cache(os.path.join(dir, 'cache'))
+        cache.__enter__()
+        try:
+            for context in CONTEXTS:
+                for key in range(KEYS_PER_CONTEXT):
+                    cache.set(str(key), '<p>cached content</p>' * 10, context)
+            # make sure everything is in memory so that we only measure hits
+            _lookups(cache, LOOKUPS // 10, 0)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(threads) as executor:
+                futures = [executor.submit(_lookups, cache, LOOKUPS // threads, seed) for seed in range(threads)]
+                for future in futures:
+                    future.result()
+            elapsed = time.perf_counter() - start
+        finally:
+            cache.__exit__(None, None, None)
+    return (LOOKUPS // threads) * threads / elapsed
+
+
+def main():
+    results = [(threads, run(threads)) for threads in [1, 16, 256]]
+    print('{:>8} {:>14}'.format('threads', 'hits/s'))
+    for threads, rate in results:
+        print('{:>8} {:>14.0f}'.format(threads, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,8 +29,12 @@ def deploy():
         files = WebFiles()
 
         for file in files.names():
-            with open(os.path.join(dir, 'conan_inquiry', file), 'wt') as f:
-                f.write(files.get_file(file, debug=False))
+            os.makedirs(os.path.dirname(os.path.join(dir, 'conan_inquiry', file)), exist_ok=True)
+            if files.is_blob(file):
+                shutil.copyfile(files.full_name(file), os.path.join(dir, 'conan_inquiry', file))
+            else:
+                with open(os.path.join(dir, 'conan_inquiry', file), 'wt') as f:
+                    f.write(files.get_file(file, debug=False))
             git('add', os.path.join(dir, 'conan_inquiry', file))
 
         git('commit', '--amend', '-m', '"Automatic deployment"')
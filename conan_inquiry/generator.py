@@ -1,7 +1,9 @@
 import datetime
 import json
+import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Tuple, Callable, Any, Optional
 
 import sys
 import yaml
@@ -11,7 +13,9 @@ from dotmap import DotMap
 from github import RateLimitExceededException
 from tqdm import tqdm
 
-from conan_inquiry.transformers.base import TransformerChain
+from conan_inquiry.manifest import Manifest, Checkpoint, code_hash, file_hash
+from conan_inquiry.scheduling import estimate_cost, longest_first, makespan, DEFAULT_REQUEST_TIME
+from conan_inquiry.transformers.base import TransformerChain, TransformCancelled
 from conan_inquiry.transformers.bintray import BintrayTransformer
 from conan_inquiry.transformers.boost import BoostTransformer
 from conan_inquiry.transformers.github import GithubTransformer
@@ -21,24 +25,19 @@ from conan_inquiry.transformers.simple import (LicenseDetectorTransformer, Autho
                                                RemoveTemporariesTransformer, AddEmptyTransformer, CategoriesTransformer,
                                                OfficiallityTransformer)
 from conan_inquiry.util.bintray import BintrayRateLimitExceeded, Bintray
-from conan_inquiry.util.cache import Cache
+from conan_inquiry.util.blobs import BlobStore
+from conan_inquiry.util.cache import Cache, OfflineCacheMiss
 from conan_inquiry.util.github import get_github_client
+from conan_inquiry.util.ratelimit import QuotaExhausted, RateLimitCancelled, get_rate_limits
 
 
-def transform_package(file):
-    # Get pre-transform data
-    data = yaml.load(open(file, 'r'))
-    if data is None:
-        print(file)
-    data['id'] = os.path.basename(os.path.splitext(file)[0]).replace('.', '_')
-    if 'exclude' in data and data['exclude'] or 'see' in data:
-        return None
+def create_transformers() -> TransformerChain:
+    """The chain of transformers used for all packages, needs to be prepared before it is used"""
 
-    # TODO: share transformer chains in the same thread
     # TODO: bitbucket transformer
     # TODO: sourceforge transformer
     # TODO: generic gitlab transformer
-    transformers = TransformerChain([
+    return TransformerChain([
         BoostTransformer,
         BintrayTransformer,
         GithubTransformer,
@@ -53,70 +52,230 @@ def transform_package(file):
         RemoveTemporariesTransformer,
         AddEmptyTransformer
     ])
+
+
+def _abort(transformers: TransformerChain):
+    """Stop all packages, including those that are waiting for a rate limit"""
+
+    transformers.cancel()
+    get_rate_limits().cancel()
+
+
+def transform_package(file, transformers: TransformerChain,
+                      dependencies: Dict[str, Dict[Tuple[str, str], Optional[float]]] = None):
+    """Transform a single package, if dependencies is given the cache entries it uses are added to it"""
+
+    if dependencies is not None:
+        with Cache.current_cache.track() as keys:
+            try:
+                return transform_package(file, transformers)
+            finally:
+                dependencies[file] = keys
+
+    # Get pre-transform data
+    data = yaml.load(open(file, 'r'))
+    if data is None:
+        print(file)
+    data['id'] = os.path.basename(os.path.splitext(file)[0]).replace('.', '_')
+    if 'exclude' in data and data['exclude'] or 'see' in data:
+        return None
+
     try:
         return transformers.transform(DotMap(data)).toDict()
-    except BintrayRateLimitExceeded or RateLimitExceededException:
+    except (BintrayRateLimitExceeded, RateLimitExceededException, QuotaExhausted):
         tqdm.write('Rate limit reached for {}'.format(data['id']))
+        # all other packages would fail in the same way, stop them early
+        _abort(transformers)
+        raise
+    except OfflineCacheMiss:
+        tqdm.write('Missing cache entry for {}'.format(data['id']))
+        _abort(transformers)
+        raise
+    except (TransformCancelled, RateLimitCancelled):
         raise
     except Exception as e:
         tqdm.write('Exception for {}'.format(data['id']))
         return data['id'], e
 
 
+def externalize_files(packages, blobs: BlobStore):
+    """Move the content of all package files into the blob store, leaving only a reference to it"""
+
+    for package in packages:
+        for file in package.get('files', dict()).values():
+            if 'content' in file:
+                file['blob'] = blobs.put(file.pop('content'))
+
+
+# errors of a single package that abort the whole run
+ABORTING_ERRORS = (BintrayRateLimitExceeded, RateLimitExceededException, QuotaExhausted, OfflineCacheMiss,
+                   TransformCancelled, RateLimitCancelled)
+
+
+def _progress(total):
+    return tqdm(total=total, unit='package', unit_scale=True, leave=True, position=0, ncols=80)
+
+
+def transform_threaded(packages, transformers: TransformerChain, concurrency: Optional[int] = None, dependencies=None,
+                       on_result: Callable[[str, Any], None] = None):
+    """
+    Transform all packages using a pool of concurrency threads, or one thread per package if it is None. Packages are
+    started in the given order, which only matters if there are fewer threads than packages. on_result is called with
+    every package and its result as soon as it is finished.
+    """
+
+    if len(packages) == 0:
+        return []
+    with ThreadPoolExecutor(concurrency or len(packages), thread_name_prefix='transform') as executor:
+        futures = {executor.submit(transform_package, package, transformers, dependencies): package
+                   for package in packages}
+        with _progress(len(futures)) as progress:
+            for future in as_completed(futures):
+                if isinstance(future.exception(), ABORTING_ERRORS):
+                    # there is no point in continuing if a rate limit is reached or the cache is incomplete
+                    _abort(transformers)
+                    for f in futures:
+                        f.cancel()
+                    raise future.exception()
+                if on_result is not None:
+                    on_result(futures[future], future.result())
+                progress.update()
+        return [f.result() for f in futures]
+
+
 class Generator:
+    manifest_file = 'manifest.json'
+    checkpoint_file = 'checkpoint.jsonl'
+
     def __init__(self, packages_dir):
         self.packages_dir = packages_dir
-        ShortDescriptionTransformer.prepare()
 
-    def transform_packages(self, development=False):
+    def transform_packages(self, development=False, max_staleness=None, stats_file=None, offline=False,
+                           concurrency=None, incremental=False, resume=False):
         """"""
 
-        github = get_github_client(3)
-        # Used to calculate the resources used
-        rate_before = github.get_rate_limit().rate
+        if not offline:
+            github = get_github_client(3)
+            # Used to calculate the resources used
+            rate_before = github.get_rate_limit().rate
+        cache = Cache(os.getenv('CACHE_FILE'), notimeout=development, offline=offline, max_staleness=max_staleness)
         try:
-            with Cache(os.getenv('CACHE_FILE'), notimeout=development):
+            with cache:
                 # Collect package files
                 packages = [os.path.join(self.packages_dir, f)
                             for f in os.listdir(self.packages_dir)
                             if os.path.isfile(os.path.join(self.packages_dir, f))]
-                with ThreadPoolExecutor(len(packages)) as executor:
-                    # Generate for all packages
-                    futures = [executor.submit(transform_package, package) for package in packages]
-                    for _ in tqdm(as_completed(futures),
-                                  total=len(futures), unit='package', unit_scale=True,
-                                  leave=True, position=0, ncols=80):
-                        pass
-
-                    # Get results from futures and filter/print errors
-                    results = [f.result() for f in futures]
-                    errors = [r for r in results if isinstance(r, tuple)]
-                    for error in errors:
-                        exc = error[1]
-                        print('Error in {}: {}\n{}'.format(
-                            error[0], str(exc),
-                            ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))))
-                    if len(errors) > 0 and not development:
-                        print('Errors in {} packages have prevented writing of packages.js'.format(len(errors)))
-                        sys.exit(1)
-                    elif len(errors) > 0 and development:
-                        print('Errors in {} packages prevented them from being generated'.format(len(errors)))
-
-                    # Write new package files
-                    data = json.dumps([r for r in results if r is not None], indent=2)
-                    with open('packages.json', 'w') as file:
-                        file.write(data)
-                    with open('packages.js', 'w') as file:
-                        file.write('var packages_data = \n')
-                        file.write(data)
-                        file.write(';')
-
-                    print('All generation steps succeeded and package data written')
+                # Set up the transformers once, they are shared by all packages
+                transformers = create_transformers()
+                with cache.track() as prepare_keys:
+                    transformers.prepare()
+
+                # Only transform packages that have changed since the last run, if requested
+                code = code_hash()
+                history = Manifest.load(self.manifest_file, code)
+                manifest = history if incremental else Manifest(code)
+                prepared = Manifest.dependencies(prepare_keys)
+                if prepared != manifest.prepared:
+                    # something all packages depend on has changed
+                    manifest = Manifest(code, prepared)
+                hashes = {package: file_hash(package) for package in packages}
+                previous = {package: manifest.previous(cache, os.path.basename(package), hashes[package])
+                            for package in packages}
+                # Packages finished by an aborted run are taken from its checkpoint, if requested
+                checkpoint = Checkpoint(self.checkpoint_file, code)
+                checkpointed = checkpoint.load() if resume else Manifest(code)
+                resumed = dict()
+                for package in packages:
+                    if previous[package] is None:
+                        previous[package] = checkpointed.previous(cache, os.path.basename(package), hashes[package])
+                        if previous[package] is not None:
+                            resumed[os.path.basename(package)] = previous[package]
+                changed = [package for package in packages if previous[package] is None]
+                if incremental or resume:
+                    print('{} of {} packages need to be transformed'.format(len(changed), len(packages)))
+                # keep the resumed packages in the new checkpoint, in case this run is aborted as well
+                checkpoint.start(resumed)
+
+                def on_result(package, result):
+                    if isinstance(result, dict):
+                        checkpoint.record(os.path.basename(package), hashes[package],
+                                          Manifest.dependencies(dependencies.get(package, dict())), result)
+
+                # Start the most expensive packages first, so that none of them is left running on its own at the end.
+                # This only has an effect with a bounded pool, with one thread per package all of them start at once
+                # and the makespan is that of the most expensive package.
+                costs = {package: estimate_cost(package, cache, history.packages.get(os.path.basename(package)))
+                         for package in changed}
+                changed = longest_first(changed, costs)
+                predicted = makespan([costs[package] for package in changed], concurrency or len(changed))
+                request_time = history.request_time or DEFAULT_REQUEST_TIME
+                print('Predicted makespan: {:.1f}s'.format(predicted * request_time))
+
+                # Generate for all packages
+                dependencies = dict()
+                start = time.monotonic()
+                transformed = transform_threaded(changed, transformers, concurrency, dependencies, on_result)
+                actual = time.monotonic() - start
+                print('Makespan: {:.1f}s predicted, {:.1f}s actual'.format(predicted * request_time, actual))
+                # calibrate the next prediction
+                manifest.request_time = actual / predicted if predicted > 0 else history.request_time
+                transformed = dict(zip(changed, transformed))
+                results = [transformed[package] if package in transformed else previous[package]['output']
+                           for package in packages]
+
+                # Filter/print errors
+                errors = [r for r in results if isinstance(r, tuple)]
+                for error in errors:
+                    exc = error[1]
+                    print('Error in {}: {}\n{}'.format(
+                        error[0], str(exc),
+                        ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))))
+                if len(errors) > 0 and not development:
+                    print('Errors in {} packages have prevented writing of packages.js'.format(len(errors)))
+                    sys.exit(1)
+                elif len(errors) > 0 and development:
+                    print('Errors in {} packages prevented them from being generated'.format(len(errors)))
+
+                # Write new package files, with file contents stored separately to be loaded on demand
+                blobs = BlobStore('blobs')
+                externalize_files([r for r in results if isinstance(r, dict)], blobs)
+                manifest.packages = dict()
+                for package, result in zip(packages, results):
+                    if previous[package] is not None:
+                        manifest.packages[os.path.basename(package)] = previous[package]
+                    elif not isinstance(result, tuple):
+                        manifest.record(os.path.basename(package), hashes[package],
+                                        Manifest.dependencies(dependencies.get(package, dict())), result)
+                results = [r for r in results if isinstance(r, dict)]
+                blobs.remove_unreferenced(set(f['blob'] for r in results for f in r.get('files', dict()).values()))
+                data = json.dumps(results, indent=2)
+                with open('packages.json', 'w') as file:
+                    file.write(data)
+                with open('packages.js', 'w') as file:
+                    file.write('var packages_data = \n')
+                    file.write(data)
+                    file.write(';')
+                manifest.save(self.manifest_file)
+                checkpoint.remove()
+
+                print('All generation steps succeeded and package data written')
         finally:
-            rate = github.get_rate_limit().rate
-            print('Github rate limiting:\n\tRemaining: {}/{}\n\tUsed this call: {}\n\tResets: {}'.format(
-                rate.remaining, rate.limit, rate_before.remaining - rate.remaining,
-                (rate.reset + datetime.timedelta(hours=1)) - datetime.datetime.now()))
+            try:
+                if not offline:
+                    try:
+                        rate = github.get_rate_limit().rate
+                        print('Github rate limiting:\n\tRemaining: {}/{}\n\tUsed this call: {}\n\tResets: {}'.format(
+                            rate.remaining, rate.limit, rate_before.remaining - rate.remaining,
+                            (rate.reset + datetime.timedelta(hours=1)) - datetime.datetime.now()))
+                    except Exception as e:
+                        # the summary must not hide the reason the run has ended for
+                        print('Github rate limiting: unknown ({})'.format(e))
 
-            bt = Bintray()
-            print('Bintray rate limiting:\n\tUsed this call: {}'.format(bt.rate_used))
+                    bt = Bintray()
+                    print('Bintray rate limiting:\n\tUsed this call: {}'.format(bt.rate_used))
+            finally:
+                cache.print_stats()
+                if stats_file is not None:
+                    with open(stats_file, 'w') as file:
+                        json.dump({context: stats.as_dict() for context, stats in cache.stats.items()}, file,
+                                  indent=2)
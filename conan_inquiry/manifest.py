@@ -0,0 +1,166 @@
+"""Bookkeeping for incremental generation"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Dict, Any, List, Tuple, Optional
+
+from conan_inquiry.util.cache import Cache
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def code_hash() -> str:
+    """Fingerprint of the code that transforms packages, a change invalidates all previous results"""
+
+    directory = os.path.dirname(os.path.realpath(__file__))
+    digest = hashlib.sha256()
+    for sub in ['transformers', 'util']:
+        for root, _, files in sorted(os.walk(os.path.join(directory, sub))):
+            for name in sorted(files):
+                if name.endswith('.py') or name.endswith('.txt'):
+                    digest.update(name.encode('utf-8'))
+                    digest.update(file_hash(os.path.join(root, name)).encode('utf-8'))
+    digest.update(file_hash(os.path.join(directory, 'generator.py')).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Records for every package the hash of its YAML file, the cache entries it has used (with the time they were
+    stored at) and its output, so that the next run only needs to transform packages of which one of these has changed
+
+    Entries used while preparing the transformers are recorded as well, as they affect all packages, and so is the
+    measured time per request, which is used to predict how long a run takes.
+    """
+
+    _version = 1
+
+    def __init__(self, code: str, prepared: List[List[Any]] = None, packages: Dict[str, Dict[str, Any]] = None,
+                 request_time: float = None):
+        self.code = code
+        self.prepared = prepared or []
+        self.packages = packages or dict()  # type: Dict[str, Dict[str, Any]]
+        self.request_time = request_time
+
+    @classmethod
+    def load(cls, file: str, code: str) -> 'Manifest':
+        """Load a manifest, an empty one is returned if the file does not exist or was written by different code"""
+
+        if not os.path.exists(file):
+            return cls(code)
+        with open(file, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != cls._version or data.get('code') != code:
+            return cls(code)
+        return cls(code, data['prepared'], data['packages'], data.get('request_time'))
+
+    def save(self, file: str):
+        directory = os.path.dirname(os.path.abspath(file))
+        # write to a temporary file first so that an existing manifest is only replaced by a complete one
+        with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            json.dump(dict(version=self._version, code=self.code, prepared=self.prepared, packages=self.packages,
+                           request_time=self.request_time), f)
+        os.replace(f.name, file)
+
+    @classmethod
+    def dependencies(cls, keys: Dict[Tuple[str, str], Optional[float]]) -> List[List[Any]]:
+        """
+        The cache entries collected by Cache.track, with the versions that have actually been used, in a form that can
+        be stored in the manifest
+        """
+
+        return [[context, key, version] for (context, key), version in sorted(keys.items())]
+
+    @classmethod
+    def _is_stale(cls, cache: Cache, dependency: List[Any], now: float) -> bool:
+        context, key, stored = dependency
+        version = cache.version(key, context)
+        if version is None:
+            return stored is not None
+        if version[0] != stored:
+            return True
+        entry_time, maxage = version
+        return maxage is not None and entry_time + maxage < now and not cache.notimeout
+
+    @classmethod
+    def up_to_date(cls, cache: Cache, dependencies: List[List[Any]]) -> bool:
+        """Check that none of the given cache entries has changed or expired"""
+
+        now = datetime.now().timestamp()
+        return not any(cls._is_stale(cache, dependency, now) for dependency in dependencies)
+
+    @classmethod
+    def stale(cls, cache: Cache, dependencies: List[List[Any]]) -> int:
+        """The number of the given cache entries that have changed or expired"""
+
+        now = datetime.now().timestamp()
+        return sum(1 for dependency in dependencies if cls._is_stale(cache, dependency, now))
+
+    def previous(self, cache: Cache, name: str, yaml_hash: str) -> Optional[Dict[str, Any]]:
+        """What has been recorded for a package, including its output, None if it needs to be transformed again"""
+
+        package = self.packages.get(name)
+        if package is None or package['yaml'] != yaml_hash or not self.up_to_date(cache, package['dependencies']):
+            return None
+        return package
+
+    def record(self, name: str, yaml_hash: str, dependencies: List[List[Any]], output):
+        self.packages[name] = dict(yaml=yaml_hash, dependencies=dependencies, output=output)
+
+
+class Checkpoint:
+    """
+    Results of the packages transformed so far by a run, appended to a file of JSON lines as soon as each one is
+    finished, so that a run which was aborted (for example because a rate limit was reached) can be resumed without
+    transforming them again. Records have the same form as those of the manifest.
+    """
+
+    _version = 1
+
+    def __init__(self, file: str, code: str):
+        self.file = file
+        self.code = code
+        self._lock = Lock()
+
+    def load(self) -> Manifest:
+        """The recorded packages, none if there is no checkpoint or it was written by different code"""
+
+        if not os.path.exists(self.file):
+            return Manifest(self.code)
+        packages = dict()
+        with open(self.file, 'r') as f:
+            header = f.readline()
+            if not header or json.loads(header) != dict(version=self._version, code=self.code):
+                return Manifest(self.code)
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # the last line may be incomplete if the run was killed while writing it
+                    break
+                packages[item['name']] = item['record']
+        return Manifest(self.code, packages=packages)
+
+    def start(self, packages: Dict[str, Dict[str, Any]] = None):
+        """Start a new checkpoint, containing the given records"""
+
+        with self._lock, open(self.file, 'w') as f:
+            f.write(json.dumps(dict(version=self._version, code=self.code)) + '\n')
+            for name, record in (packages or dict()).items():
+                f.write(json.dumps(dict(name=name, record=record)) + '\n')
+
+    def record(self, name: str, yaml_hash: str, dependencies: List[List[Any]], output):
+        with self._lock, open(self.file, 'a') as f:
+            f.write(json.dumps(dict(name=name, record=dict(yaml=yaml_hash, dependencies=dependencies,
+                                                           output=output))) + '\n')
+
+    def remove(self):
+        if os.path.exists(self.file):
+            os.remove(self.file)
@@ -3,6 +3,7 @@
 import argparse
 import logging
 import os
+from datetime import timedelta
 from http.server import HTTPServer
 
 from conan_inquiry.deployment import deploy
@@ -11,6 +12,7 @@ from conan_inquiry.generator import Generator
 from conan_inquiry.util.github import get_github_client
 from conan_inquiry.web.server import DevelopmentHTTPRequestHandler
 from conan_inquiry.util.cache import Cache
+from conan_inquiry.util.fixtures import fixtures
 from conan_inquiry.validator import validate_packages
 
 
@@ -22,10 +24,34 @@ def main():
 
     gen = subparsers.add_parser('generate', help='generates final json file from yaml files')
     gen.add_argument('--development', action='store_true', help='turns on various options useful for development')
+    gen.add_argument('--max-staleness', type=float, metavar='DAYS',
+                     help='use expired cache entries up to DAYS after expiry and refresh them in the background')
+    gen.add_argument('--cache-stats', metavar='FILE', help='write cache usage statistics as JSON to FILE')
+    gen.add_argument('--offline', action='store_true',
+                     help='only use the cache, regardless of its age, and fail on anything that is not cached')
+    gen.add_argument('--concurrency', type=int, metavar='N',
+                     help='transform at most N packages at the same time, most expensive first, '
+                          'instead of all of them at once')
+    gen.add_argument('--incremental', action='store_true',
+                     help='only transform packages whose file or cached data has changed since the last run')
+    gen.add_argument('--resume', action='store_true',
+                     help='only transform packages that were not finished by the last, aborted, run')
+    gen.add_argument('--record', metavar='FILE', help='record all HTTP requests and their responses to FILE')
+    gen.add_argument('--replay', metavar='FILE',
+                     help='answer all HTTP requests from responses recorded in FILE instead of the network')
+    gen.add_argument('--latency', type=float, default=0, metavar='MS',
+                     help='delay every replayed response by MS milliseconds')
     subparsers.add_parser('find', help='finds conan recipies')
     subparsers.add_parser('validate', help='validates the generated json file')
     subparsers.add_parser('deploy', help='deploys files to GitHub pages')
     subparsers.add_parser('server', help='starts a development server')
+    cache_parser = subparsers.add_parser('cache', help='manages the cache')
+    cache_subparsers = cache_parser.add_subparsers(help='cache sub-command help', dest='cache_command')
+    cache_subparsers.add_parser('compact', help='removes expired entries and shrinks the cache file')
+    cache_export = cache_subparsers.add_parser('export', help='writes the cache to a compressed snapshot file')
+    cache_export.add_argument('snapshot')
+    cache_import = cache_subparsers.add_parser('import', help='adds the entries of a snapshot file to the cache')
+    cache_import.add_argument('snapshot')
 
     args = parser.parse_args()
 
@@ -33,7 +59,10 @@ def main():
     if args.subparser_name == 'generate':
         if args.development:
             print('Running with development options enabled.')
-        Generator(dir).transform_packages(args.development)
+        max_staleness = timedelta(days=args.max_staleness) if args.max_staleness is not None else None
+        with fixtures(args.record, args.replay, args.latency / 1000):
+            Generator(dir).transform_packages(args.development, max_staleness, args.cache_stats, args.offline,
+                                              args.concurrency, args.incremental, args.resume)
     elif args.subparser_name == 'find':
         # GithubFinder(get_github_client(3)).print()
         with Cache():
@@ -49,6 +78,22 @@ def main():
         httpd = HTTPServer(('', 8000), DevelopmentHTTPRequestHandler)
         print('Server ready on port {}'.format(httpd.server_port))
         httpd.serve_forever()
+    elif args.subparser_name == 'cache':
+        if args.cache_command == 'compact':
+            with Cache(os.getenv('CACHE_FILE')) as cache:
+                before, after = cache.compact()
+            print('Cache size before: {:.1f} MiB\nCache size after: {:.1f} MiB'.format(before / 1024 / 1024,
+                                                                                       after / 1024 / 1024))
+        elif args.cache_command == 'export':
+            with Cache(os.getenv('CACHE_FILE')) as cache:
+                count = cache.export_snapshot(args.snapshot)
+            print('Exported {} entries to {}'.format(count, args.snapshot))
+        elif args.cache_command == 'import':
+            with Cache(os.getenv('CACHE_FILE')) as cache:
+                count = cache.import_snapshot(args.snapshot)
+            print('Imported {} entries from {}'.format(count, args.snapshot))
+        else:
+            parser.error('missing cache sub-command')
 
 
 if __name__ == '__main__':
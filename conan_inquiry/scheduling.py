@@ -0,0 +1,60 @@
+"""Ordering of packages by their expected cost, so that the most expensive ones do not start last"""
+
+import heapq
+import os
+from typing import Dict, Any, Iterable, List, Optional
+
+import yaml
+
+from conan_inquiry.manifest import Manifest
+from conan_inquiry.util.cache import Cache
+
+# requests needed for each source of a package that has not been transformed before
+REQUESTS_PER_RECIPE = 3  # package and file list from Bintray, and the conanfile
+REQUESTS_PER_GITHUB = 1  # a single GraphQL query, including README and license
+REQUESTS_PER_GITLAB = 2  # project and README
+REQUESTS_PER_BOOST = 2  # library metadata and documentation
+# cost of a package that needs no requests at all, in requests
+OVERHEAD = 0.1
+# seconds per request, until a run has been measured
+DEFAULT_REQUEST_TIME = 0.5
+
+
+def estimate_cost(file: str, cache: Cache, record: Optional[Dict[str, Any]] = None) -> float:
+    """
+    The expected number of requests needed to transform a package. If a previous run has recorded which cache entries
+    the package uses only those that have changed or expired are counted, otherwise the number is derived from the
+    recipes and sources in its YAML file.
+    """
+
+    if record is not None:
+        return OVERHEAD + Manifest.stale(cache, record['dependencies'])
+
+    with open(file, 'r') as f:
+        data = yaml.load(f)
+    if data is None or 'exclude' in data and data['exclude'] or 'see' in data:
+        return OVERHEAD
+    urls = data.get('urls') or dict()
+    recipes = [r for r in data.get('recipies') or [] if 'bintray' in (r.get('repo') or dict())]
+    cost = OVERHEAD + REQUESTS_PER_RECIPE * len(recipes)
+    if 'gitlab' in urls:
+        cost += REQUESTS_PER_GITLAB
+    # Boost libraries get their Github repository from the Boost transformer
+    if os.path.basename(file).startswith('boost.'):
+        cost += REQUESTS_PER_BOOST + REQUESTS_PER_GITHUB
+    elif 'github' in urls:
+        cost += REQUESTS_PER_GITHUB
+    return cost
+
+
+def longest_first(packages: Iterable[str], costs: Dict[str, float]) -> List[str]:
+    return sorted(packages, key=lambda package: costs[package], reverse=True)
+
+
+def makespan(costs: Iterable[float], workers: int) -> float:
+    """The time until all jobs are done if each of them, in the given order, is started by the first free worker"""
+
+    finish = [0.0] * max(workers, 1)
+    for cost in costs:
+        heapq.heapreplace(finish, finish[0] + cost)
+    return max(finish)
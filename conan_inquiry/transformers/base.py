@@ -1,15 +1,16 @@
 import abc
+import copy
 import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from inspect import isclass
+from typing import Optional, Set, List
 
-import requests
-from cachecontrol import CacheControl
 from dotmap import DotMap
 from tqdm import tqdm
 
 from conan_inquiry.util.cache import Cache
-from conan_inquiry.util.github import get_github_client
+from conan_inquiry.util.http import get_http_session
 
 
 class BaseTransformer:
@@ -18,10 +19,22 @@ class BaseTransformer:
 
     A transformer takes a package and changes it in some way, adding information that is either implied from existing
     fields or retrieving it from outside sources.
+
+    A single instance of each transformer is used for all packages of a run, from several threads at once, so transform
+    must not modify the transformer itself. Anything that is needed for all packages should be set up in prepare.
+
+    Transformers declare the package fields they read and write, as dotted paths such as "urls.github". None stands
+    for the whole package. Fields that are only set if they are empty (see _set_unless_exists) count as written, not as
+    read, as the order in which transformers are applied still decides which one sets them.
     """
 
     __metaclass__ = abc.ABCMeta
 
+    reads = None  # type: Optional[Set[str]]
+    writes = None  # type: Optional[Set[str]]
+    # whether transform mostly waits for the network, see TransformerChain
+    network = False
+
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
@@ -34,6 +47,10 @@ class BaseTransformer:
         if key not in obj or obj[key] is None or obj[key] == '':
             obj[key] = value
 
+    def prepare(self):
+        """Called once per run, with the cache open, before any package is transformed"""
+        pass
+
     @abc.abstractmethod
     def transform(self, package: DotMap) -> DotMap:
         """The main method, needs to be reimplemented by all subclasses"""
@@ -45,39 +62,118 @@ class BaseTransformer:
         return Cache.current_cache
 
 
+class TransformCancelled(Exception):
+    def __init__(self, package_id, *args):
+        super().__init__('Transform of {} cancelled'.format(package_id), *args)
+
+
 class TransformerChain(BaseTransformer):
+    """
+    Applies the transformers to a package one after another, in the given order
+
+    The fields transformers read and write form a dependency graph: a transformer depends on all earlier ones that
+    write a field it reads. As soon as all dependencies of a network transformer have been applied to a package, the
+    transformer is also run ahead of time on a copy of the package, so that the requests of independent network
+    transformers are made concurrently. Its result is thrown away, but the responses end up in the cache, where the
+    transformer finds them once it is actually applied. Packages thus are transformed exactly as if the transformers
+    only ran one after another.
+    """
+
     progress_bar_index = 0
+    # threads running transformers ahead of time, shared by all packages
+    prefetch_workers = 32
 
     def __init__(self, transformers):
         super().__init__()
         # construct transformers who are given as classes
         self.transformers = [t() if isclass(t) else t for t in transformers]
+        self.dependencies = [self._dependencies(index) for index in range(len(self.transformers))]
+        self._cancelled = threading.Event()
+        self._prefetch = None  # type: ThreadPoolExecutor
+
+    @classmethod
+    def _overlap(cls, fields: Optional[Set[str]], other: Optional[Set[str]]) -> bool:
+        if fields is None or other is None:
+            return True
+        return any(a == b or a.startswith(b + '.') or b.startswith(a + '.') for a in fields for b in other)
+
+    def _dependencies(self, index: int) -> List[int]:
+        """The indices of the earlier transformers that write fields the transformer at index reads"""
+
+        reads = self.transformers[index].reads
+        return [i for i, transformer in enumerate(self.transformers[:index])
+                if self._overlap(transformer.writes, reads)]
+
+    def cancel(self):
+        """Stop all transforms, running ones raise TransformCancelled before their next transformer"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def prepare(self):
+        for transformer in self.transformers:
+            transformer.logger.info('Preparing')
+            transformer.prepare()
+        if self._prefetch is None:
+            self._prefetch = ThreadPoolExecutor(self.prefetch_workers, thread_name_prefix='prefetch')
+
+    def _run_ahead(self, transformer: BaseTransformer, package: DotMap):
+        try:
+            transformer.transform(package)
+        except Exception as e:
+            # the same error occurs again once the transformer is applied, and is handled there
+            transformer.logger.debug('Running ahead for "%s" failed: %s', package.id, e)
+
+    def _start_ahead(self, package: DotMap, applied: int, ahead: dict):
+        """Run all network transformers ahead of time whose last dependency is the one at applied"""
+
+        if self._prefetch is None or self.cancelled:
+            return
+        for index in range(applied + 2, len(self.transformers)):
+            transformer = self.transformers[index]
+            last = self.dependencies[index][-1] if self.dependencies[index] else -1
+            if transformer.network and last == applied:
+                ahead[index] = self._prefetch.submit(self._run_ahead, transformer, copy.deepcopy(package))
 
     def transform(self, package):
         self.logger.info('Starting transform of "%s" in thread %s', package.id,
                          threading.current_thread().getName())
         self.progress_bar_index += 1
-        # TODO: nested tqdm progress bars here
-        for transformer in self.transformers:
-            # tqdm(self.transformers, postfix=dict(pkg=package.id), position=self.progress_bar_index):
-            transformer.logger.info('Transforming "%s"', package.id)
-            package = transformer.transform(package)
-        self.progress_bar_index -= 1
+        ahead = dict()
+        try:
+            self._start_ahead(package, -1, ahead)
+            # TODO: nested tqdm progress bars here
+            for index, transformer in enumerate(self.transformers):
+                if self.cancelled:
+                    raise TransformCancelled(package.id)
+                future = ahead.pop(index, None)
+                if future is not None and not future.cancel():
+                    # already running, the transformer would only wait for the same responses
+                    wait([future])
+                # tqdm(self.transformers, postfix=dict(pkg=package.id), position=self.progress_bar_index):
+                transformer.logger.info('Transforming "%s"', package.id)
+                package = transformer.transform(package)
+                self._start_ahead(package, index, ahead)
+        finally:
+            for future in ahead.values():
+                future.cancel()
+            self.progress_bar_index -= 1
         self.logger.info('"%s" done', package.id)
         return package
 
 
 class BaseHTTPTransformer(BaseTransformer):
+    network = True
+
     def __init__(self):
         super().__init__()
-        self.http = CacheControl(requests.session())
+        self.http = get_http_session()
 
 
 class BaseGithubTransformer(BaseHTTPTransformer):
-    def __init__(self):
-        super().__init__()
-        self.github = get_github_client(3)
-        self.github_graph = get_github_client(4)
-
-    def _set_repo(self, name):
-        self.repo = self.github.get_repo(name)
+    """
+    Base class for transformers using Github. Repository details come from the GraphQL API only, through the batcher
+    shared by all packages.
+    """
@@ -5,11 +5,20 @@ from natsort import natsorted
 
 from conan_inquiry.transformers.base import BaseHTTPTransformer
 from conan_inquiry.util.bintray import Bintray
+from conan_inquiry.util.http import conditional_get
 
 
 class BintrayTransformer(BaseHTTPTransformer):
+    reads = {'recipies'}
+    writes = {'recipies', 'versions', 'name', 'description', 'keywords', 'licenses', 'urls.github',
+              'urls.website', 'urls.issues', 'files.conanfile'}
+
     def __init__(self):
         super().__init__()
+        self.bt = None  # type: Bintray
+        self.licenses = []
+
+    def prepare(self):
         self.bt = Bintray()
         self.licenses = self.bt.load_licenses()
 
@@ -90,5 +99,9 @@ class BintrayTransformer(BaseHTTPTransformer):
                                             self.bt.download_url('/'.join(parts[:2]),
                                                                  conanfile['path']))
                     self._set_unless_exists(package.files.conanfile, 'content',
-                                            self.http.get(package.files.conanfile.url).text)
+                                            self.cache.get_conditional(
+                                                package.files.conanfile.url, timedelta(days=28), 'conanfile',
+                                                lambda validators: conditional_get(package.files.conanfile.url,
+                                                                                   validators, http=self.http),
+                                                locked_getter=False))
         return package
@@ -5,17 +5,20 @@ from bs4 import BeautifulSoup
 from dotmap import DotMap
 
 from conan_inquiry.transformers.base import BaseHTTPTransformer
+from conan_inquiry.util.http import conditional_get
 
 
 class BoostTransformer(BaseHTTPTransformer):
+    reads = {'id', 'urls.boost'}
+    writes = {'name', 'short_description', 'description', 'keywords', 'authors', 'urls.github', 'urls.issues',
+              'urls.docs'}
+
     author_re = re.compile(r'<h3 class="author">(.*?)</h3>')
     first_ps_re = re.compile(
         r'<div class="chapter">.*<div class="section">.*<div class="titlepage">.*?(<p>.*?<\/p>)<[^p]+>')
     first_p_re = re.compile(r'<p>(.*?)</p>')
     blockquote_re = re.compile(r'<blockquote.*?</blockquote>')
 
-    listing = None
-
     def _listing(self):
         raw = self.http.get('https://www.boost.org/doc/libs/')
         bs = BeautifulSoup(raw.text, 'html.parser')
@@ -39,15 +42,21 @@ class BoostTransformer(BaseHTTPTransformer):
 
     def __init__(self):
         super().__init__()
-        authors_text = self.http.get(
-            'https://raw.githubusercontent.com/boostorg/boost/master/libs/maintainers.txt').text
+        self.authors = dict()
+        self.listing = []
+
+    def prepare(self):
+        maintainers_url = 'https://raw.githubusercontent.com/boostorg/boost/master/libs/maintainers.txt'
+        authors_text = self.cache.get_conditional(maintainers_url, timedelta(days=28), 'boost_docs',
+                                                  lambda validators: conditional_get(maintainers_url, validators,
+                                                                                     http=self.http),
+                                                  locked_getter=False)
         self.authors = {line.split(' ')[0]: ' '.join(line.split(' ')[1:]).strip()
                         for line in authors_text.split('\n')
                         if not line.startswith('#') and line.strip() != ''}
 
-        if self.listing is None:
-            self.listing = self.cache.get('boost_listing', maxage=timedelta(days=28),
-                                          func=self._listing, locked_getter=True)
+        self.listing = self.cache.get('boost_listing', maxage=timedelta(days=28),
+                                      func=self._listing, locked_getter=True)
 
     def transform(self, package):
         if package.id.startswith('boost_'):
@@ -63,24 +72,22 @@ class BoostTransformer(BaseHTTPTransformer):
                 self._set_unless_exists(package, 'name',
                                         'Boost.' + ''.join([i.title() for i in boost_id.split('_')]))
 
-            def http_get_json(url):
-                res = self.http.get(url)
-                return dict(
+            def http_get_json(url, validators):
+                return conditional_get(url, validators, lambda res: dict(
                     code=res.status_code,
                     json=res.json() if res.status_code == 200 else None
-                )
+                ), http=self.http)
 
-            def http_get_text(url):
-                res = self.http.get(url)
-                return dict(
+            def http_get_text(url, validators):
+                return conditional_get(url, validators, lambda res: dict(
                     code=res.status_code,
                     text=res.text if res.status_code == 200 else None
-                )
+                ), http=self.http)
 
             metaurl = 'https://raw.githubusercontent.com/boostorg/' + boost_id + '/develop/meta/libraries.json'
-            metares = self.cache.get(metaurl, timedelta(days=1), 'boost_docs',
-                                     lambda: http_get_json(metaurl),
-                                     locked_getter=False)
+            metares = self.cache.get_conditional(metaurl, timedelta(days=1), 'boost_docs',
+                                                 lambda validators: http_get_json(metaurl, validators),
+                                                 locked_getter=False)
             if metares['code'] == 200:
                 package.urls.github = 'boostorg/' + boost_id
 
@@ -107,9 +114,9 @@ class BoostTransformer(BaseHTTPTransformer):
             else:
                 boost_url = package.urls.boost if 'boost' in package.urls else boost_id
                 docurl = 'http://www.boost.org/doc/libs/release/libs/' + boost_url
-                docres = self.cache.get(docurl, timedelta(days=1), 'boost_docs',
-                                        lambda: http_get_text(docurl),
-                                        locked_getter=False)
+                docres = self.cache.get_conditional(docurl, timedelta(days=1), 'boost_docs',
+                                                    lambda validators: http_get_text(docurl, validators),
+                                                    locked_getter=False)
                 if docres['code'] == 200:
                     self._set_unless_exists(package.urls, 'docs', docurl)
 
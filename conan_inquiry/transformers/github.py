@@ -1,201 +1,241 @@
+import hashlib
 import json
-import os
-from base64 import b64decode
 from datetime import timedelta
-from threading import Semaphore
+from threading import Lock
 
-import github
 from dotmap import DotMap
-from github import GithubException
 
 from conan_inquiry.transformers.base import BaseGithubTransformer
 from conan_inquiry.util.general import render_readme
+from conan_inquiry.util.github import GraphQLBatcher, get_github_client
 from conan_inquiry.util.travis import repo_has_travis
 
 
+def _blob_fields(alias, names):
+    """GraphQL fields for the text of each of the given files in the default branch, aliased as alias0, alias1, ..."""
+
+    return ''.join('''
+          {}{}: object(expression: "HEAD:{}") {{
+            ... on Blob {{
+              text
+            }}
+          }}'''.format(alias, i, name) for i, name in enumerate(names))
+
+
 class GithubTransformer(BaseGithubTransformer):
     """
     Populates empty urls based on the Github url, if given
     """
 
-    github_limit = Semaphore(value=15)
+    reads = {'urls.github', 'name', 'recipies'}
+    writes = {'description', 'license', '_license_data', 'authors', 'keywords', 'recipies', 'stats', 'urls.website',
+              'urls.code', 'urls.issues', 'urls.wiki', 'urls.travis', 'urls.git', 'urls.readme', 'files.readme'}
+
+    # candidates for the README and license, in order of preference. Github itself accepts a README in any case and
+    # with any extension, these are the spellings that are actually used.
+    readme_files = ['README.md', 'README.markdown', 'README.rst', 'README.rest', 'README.txt', 'README',
+                    'readme.md', 'readme.markdown', 'readme.rst', 'readme.txt', 'readme',
+                    'Readme.md', 'Readme.markdown', 'Readme.rst', 'Readme.txt', 'Readme']
+    license_files = ['LICENSE', 'License', 'license']
+
+    # fields of a repository that are retrieved using GraphQL
+    repo_fragment = '''
+        fragment RepoFields on Repository {
+          owner {
+            login
+            ... on Organization {
+              name
+              orgEmail: email
+              websiteUrl
+            }
+            ... on User {
+              name
+              userEmail: email
+              websiteUrl
+            }
+          }
+          repositoryTopics(first: 20) {
+            totalCount
+            nodes {
+              topic {
+                name
+              }
+            }
+          }
+          forks {
+            totalCount
+          }
+          description
+          hasIssuesEnabled
+          hasWikiEnabled
+          homepageUrl
+          url
+          openIssues: issues(states: OPEN) {
+            totalCount
+          }
+          closedIssues: issues(states: CLOSED) {
+            totalCount
+          }
+          openPRs: pullRequests(states: OPEN) {
+            totalCount
+          }
+          closedPRs: pullRequests(states: CLOSED) {
+            totalCount
+          }
+          pushedAt
+          nameWithOwner
+          defaultBranchRef {
+            name
+            target {
+              ... on Commit {
+                history(first: 1) {
+                  totalCount
+                  nodes {
+                    committedDate
+                  }
+                }
+              }
+            }
+          }
+          stargazers {
+            totalCount
+          }
+          watchers {
+            totalCount
+          }''' + _blob_fields('readme', readme_files) + _blob_fields('license', license_files) + '''
+        }
+    '''
+
+    _graph_batcher = None  # type: GraphQLBatcher
+    _graph_batcher_lock = Lock()
+
+    @classmethod
+    def graph_batcher(cls) -> GraphQLBatcher:
+        """The batcher shared by all instances, so that queries from all packages end up in the same batches"""
+
+        with cls._graph_batcher_lock:
+            if cls._graph_batcher is None:
+                cls._graph_batcher = GraphQLBatcher(get_github_client(4), cls.repo_fragment, 'RepoFields')
+            return cls._graph_batcher
+
+    @classmethod
+    def _blob(cls, repo, alias, names):
+        """The name and text of the first of the files retrieved using _blob_fields that exists"""
+
+        for i, name in enumerate(names):
+            blob = repo.get(alias + str(i))
+            if blob is not None and blob.get('text') is not None:
+                return name, blob['text']
+        return None, None
+
+    @classmethod
+    def _blob_url(cls, repo, name):
+        return repo['url'] + '/blob/' + repo['defaultBranchRef']['name'] + '/' + name
+
+    @classmethod
+    def _raw_url(cls, repo, name):
+        return 'https://raw.githubusercontent.com/' + repo['nameWithOwner'] + '/' + repo['defaultBranchRef']['name'] + \
+               '/' + name
+
+    @classmethod
+    def _graph_key(cls, github_id):
+        # entries retrieved with a different set of fields are not used
+        return github_id + '#' + hashlib.sha1(cls.repo_fragment.encode('utf-8')).hexdigest()[:8]
 
     def transform(self, package):
         if 'github' in package.urls:
-            with self.github_limit:
-                github_id = package.urls.github.replace('.git', '')
-                try:
-                    self._set_repo(github_id)
-                    v3data = self.cache.get(github_id, timedelta(days=2), 'github_api',
-                                            lambda: self._v3_requests(),
-                                            locked_getter=False)
-                    num_contributors = v3data['num_contributors']
-                    latest_commit = v3data['latest_commit']
-                    clone_url = v3data['clone_url']
-                    repo_owner = v3data['repo_owner']
-                    repo_name = v3data['repo_name']
-
-                    graph_request = '''
-                        query Repo($owner:String!, $name:String!) {
-                          repo: repository(owner: $owner, name: $name) {
-                            owner {
-                              login
-                              ... on Organization {
-                                name
-                                orgEmail: email
-                                websiteUrl
-                              }
-                              ... on User {
-                                name
-                                userEmail: email
-                                websiteUrl
-                              }
-                            }
-                            tree: object(expression: "HEAD:") {
-                              ... on Tree {
-                                entries {
-                                  name
-                                }
-                              }
-                            }
-                            repositoryTopics(first: 20) {
-                              totalCount
-                              nodes {
-                                topic {
-                                  name
-                                }
-                              }
-                            }
-                            forks {
-                              totalCount
-                            }
-                            description
-                            hasIssuesEnabled
-                            hasWikiEnabled
-                            homepageUrl
-                            url
-                            openIssues: issues(states: OPEN) {
-                              totalCount
-                            }
-                            closedIssues: issues(states: CLOSED) {
-                              totalCount
-                            }
-                            openPRs: pullRequests(states: OPEN) {
-                              totalCount
-                            }
-                            closedPRs: pullRequests(states: CLOSED) {
-                              totalCount
-                            }
-                            pushedAt
-                            stargazers {
-                              totalCount
-                            }
-                            watchers {
-                              totalCount
-                            }
-                          }
-                          rateLimit {
-                            cost
-                            remaining
-                          }
-                        }
-                    '''
-                    graph_data = self.cache.get(github_id, timedelta(days=2), 'github_graph',
-                                                lambda: self.github_graph.execute(
-                                                    graph_request,
-                                                    dict(owner=repo_owner,
-                                                         name=repo_name)),
-                                                locked_getter=False)
-                    graph = json.loads(graph_data)['data']
-                except GithubException:
-                    return package
-
-                if graph['repo']['description'] != package.name:
-                    self._set_unless_exists(package, 'description', graph['repo']['description'])
-
-                self._set_unless_exists(package.urls, 'website', graph['repo']['homepageUrl'])
-                self._set_unless_exists(package.urls, 'website', 'https://github.com/' + github_id)
-                self._set_unless_exists(package.urls, 'code', graph['repo']['url'])
-                if graph['repo']['hasIssuesEnabled']:
-                    self._set_unless_exists(package.urls, 'issues', graph['repo']['url'] + '/issues')
-                if graph['repo']['hasWikiEnabled']:
-                    # TODO: check if there is content in the wiki
-                    self._set_unless_exists(package.urls, 'wiki', graph['repo']['url'] + '/wiki')
-
-                if repo_has_travis(github_id, self.http):
-                    self._set_unless_exists(package.urls, 'travis',
-                                            'https://travis-ci.org/' + github_id)
-                self._set_unless_exists(package.urls, 'git', clone_url)
-
-                try:
-                    def get_readme(repo, github):
-                        readme = repo.get_readme()
-                        rendered = render_readme(readme.path, readme.decoded_content.decode('utf-8'),
-                                                 graph['repo']['url'],
-                                                 lambda raw: github.render_markdown(raw, repo).decode('utf-8'))
-                        return dict(url=readme.html_url, content=rendered)
-
-                    readme = self.cache.get(github_id, timedelta(days=7), 'github_readme',
-                                            lambda: get_readme(self.repo, self.github),
-                                            locked_getter=False)
-                    self._set_unless_exists(package.urls, 'readme', readme['url'])
-                    self._set_unless_exists(package.files.readme, 'url', readme['url'])
-                    self._set_unless_exists(package.files.readme, 'content', readme['content'])
-                except github.UnknownObjectException:
-                    pass
-
-                for entry in graph['repo']['tree']['entries']:
-                    if os.path.basename(entry['name']).lower() == 'license':
-                        def get_file(repo, name):
-                            f = repo.get_file_contents(name)
-                            return dict(url=f.html_url, string=str(b64decode(f.content)))
-
-                        file = self.cache.get(github_id + '->' + entry['name'], timedelta(days=28), 'github_file',
-                                              lambda: get_file(self.repo, entry['name']),
-                                              locked_getter=False)
-                        self._set_unless_exists(package, 'license', file['url'])
-                        self._set_unless_exists(package, '_license_data', file['string'])
-                        break
-
-                if 'authors' not in package:
-                    owner = graph['repo']['owner']
-                    if 'userEmail' in owner:
-                        # private repo
-                        name = owner['name'] if owner['name'] is not None else owner['login']
-                        author = DotMap(name=name,
-                                        github=owner['login'])
-                        email = owner['userEmail']
-                        website = owner['websiteUrl']
-                        if email is not None:
-                            author.email = email
-                        if website is not None:
-                            author.website = website
-                        package.authors = [author]
-                    else:
-                        # organization repo
-                        name = owner['name'] if owner['name'] is not None else owner['login']
-                        author = DotMap(name=name,
-                                        github=owner['login'])
-                        email = owner['orgEmail']
-                        website = owner['websiteUrl']
-                        if email is not None:
-                            author.email = email
-                        if website is not None:
-                            author.website = website
-                        package.authors = [author]
-
-                self._set_unless_exists(package.stats, 'github_prs', graph['repo']['openPRs']['totalCount'])
-                self._set_unless_exists(package.stats, 'github_issues', graph['repo']['openIssues']['totalCount'])
-                self._set_unless_exists(package.stats, 'github_stars', graph['repo']['stargazers']['totalCount'])
-                self._set_unless_exists(package.stats, 'github_watchers', graph['repo']['watchers']['totalCount'])
-                self._set_unless_exists(package.stats, 'github_forks', graph['repo']['forks']['totalCount'])
-                if num_contributors is not None:
-                    self._set_unless_exists(package.stats, 'github_commits', num_contributors)
+            github_id = package.urls.github.replace('.git', '')
+            repo_owner, repo_name = github_id.split('/')[:2]
+            graph_data = self.cache.get(self._graph_key(github_id), timedelta(days=2), 'github_graph',
+                                        lambda: self.graph_batcher().load(repo_owner, repo_name),
+                                        locked_getter=False)
+            graph = json.loads(graph_data)['data']
+            if graph['repo'] is None:
+                # the repository does not exist (anymore)
+                return package
+
+            num_commits = None
+            latest_commit = None
+            branch = graph['repo']['defaultBranchRef']
+            if branch is not None and 'history' in branch['target']:
+                num_commits = branch['target']['history']['totalCount']
+                commits = branch['target']['history']['nodes']
+                if len(commits) > 0:
+                    latest_commit = commits[0]['committedDate']
+
+            if graph['repo']['description'] != package.name:
+                self._set_unless_exists(package, 'description', graph['repo']['description'])
+
+            self._set_unless_exists(package.urls, 'website', graph['repo']['homepageUrl'])
+            self._set_unless_exists(package.urls, 'website', 'https://github.com/' + github_id)
+            self._set_unless_exists(package.urls, 'code', graph['repo']['url'])
+            if graph['repo']['hasIssuesEnabled']:
+                self._set_unless_exists(package.urls, 'issues', graph['repo']['url'] + '/issues')
+            if graph['repo']['hasWikiEnabled']:
+                # TODO: check if there is content in the wiki
+                self._set_unless_exists(package.urls, 'wiki', graph['repo']['url'] + '/wiki')
+
+            if repo_has_travis(github_id, self.http):
+                self._set_unless_exists(package.urls, 'travis',
+                                        'https://travis-ci.org/' + github_id)
+            self._set_unless_exists(package.urls, 'git', graph['repo']['url'] + '.git')
+
+            readme_name, readme_text = self._blob(graph['repo'], 'readme', self.readme_files)
+            if readme_text is not None:
+                readme_url = self._blob_url(graph['repo'], readme_name)
+
+                # relative links point to files as they are shown on Github, images to the files themselves
+                readme = render_readme(readme_name, readme_text, self._blob_url(graph['repo'], ''),
+                                       src_absolute_url=self._raw_url(graph['repo'], ''))
+                self._set_unless_exists(package.urls, 'readme', readme_url)
+                self._set_unless_exists(package.files.readme, 'url', readme_url)
+                self._set_unless_exists(package.files.readme, 'content', readme)
+
+            license_name, license_text = self._blob(graph['repo'], 'license', self.license_files)
+            if license_text is not None:
+                self._set_unless_exists(package, 'license', self._blob_url(graph['repo'], license_name))
+                self._set_unless_exists(package, '_license_data', license_text)
+
+            if 'authors' not in package:
+                owner = graph['repo']['owner']
+                if 'userEmail' in owner:
+                    # private repo
+                    name = owner['name'] if owner['name'] is not None else owner['login']
+                    author = DotMap(name=name,
+                                    github=owner['login'])
+                    email = owner['userEmail']
+                    website = owner['websiteUrl']
+                    if email is not None:
+                        author.email = email
+                    if website is not None:
+                        author.website = website
+                    package.authors = [author]
+                else:
+                    # organization repo
+                    name = owner['name'] if owner['name'] is not None else owner['login']
+                    author = DotMap(name=name,
+                                    github=owner['login'])
+                    email = owner['orgEmail']
+                    website = owner['websiteUrl']
+                    if email is not None:
+                        author.email = email
+                    if website is not None:
+                        author.website = website
+                    package.authors = [author]
+
+            self._set_unless_exists(package.stats, 'github_prs', graph['repo']['openPRs']['totalCount'])
+            self._set_unless_exists(package.stats, 'github_issues', graph['repo']['openIssues']['totalCount'])
+            self._set_unless_exists(package.stats, 'github_stars', graph['repo']['stargazers']['totalCount'])
+            self._set_unless_exists(package.stats, 'github_watchers', graph['repo']['watchers']['totalCount'])
+            self._set_unless_exists(package.stats, 'github_forks', graph['repo']['forks']['totalCount'])
+            if num_commits is not None:
+                self._set_unless_exists(package.stats, 'github_commits', num_commits)
+            if latest_commit is not None:
                 self._set_unless_exists(package.stats, 'github_latest_commit', latest_commit)
 
-                if 'keywords' not in package:
-                    package.keywords = []
-                package.keywords.extend([r['topic']['name'] for r in graph['repo']['repositoryTopics']['nodes']])
+            if 'keywords' not in package:
+                package.keywords = []
+            package.keywords.extend([r['topic']['name'] for r in graph['repo']['repositoryTopics']['nodes']])
 
         for recipie in package.recipies:
             if 'github' in recipie.urls:
@@ -203,19 +243,3 @@ class GithubTransformer(BaseGithubTransformer):
                 self._set_unless_exists(recipie.urls, 'issues', 'https://github.com/' + recipie.urls.github + '/issues')
 
         return package
-
-    def _v3_requests(self):
-        # TODO: the number of commits does not seem to be correct and sometimes fetching doesn't work at all
-        contributors = self.repo.get_stats_contributors()
-        if contributors is not None:
-            num_contributors = sum([c.total for c in contributors])
-        else:
-            num_contributors = None
-        commits = self.repo.get_commits()
-        latest_commit = commits[0].commit.committer.date.isoformat()
-        clone_url = self.repo.clone_url
-        repo_owner = self.repo.owner.login
-        repo_name = self.repo.name
-
-        return dict(num_contributors=num_contributors, latest_commit=latest_commit,
-                    clone_url=clone_url, repo_owner=repo_owner, repo_name=repo_name)
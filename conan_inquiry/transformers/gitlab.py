@@ -4,9 +4,15 @@ from datetime import timedelta
 from gitlab import Gitlab
 
 from conan_inquiry.transformers.base import BaseTransformer
+from conan_inquiry.util.fixtures import get_transport
+from conan_inquiry.util.http import get_http_session
 
 
 class GitLabTransformer(BaseTransformer):
+    reads = {'urls.gitlab'}
+    writes = {'name', 'description', 'logo', 'stats', 'urls.git', 'urls.code', 'urls.issues'}
+    network = True
+
     def transform(self, package):
         if 'gitlab' in package.urls:
             clean = package.urls.gitlab.replace('https://', '').replace('http://', '').split('/')
@@ -18,12 +24,12 @@ class GitLabTransformer(BaseTransformer):
                 project = '/'.join(clean[1:3])
             env_name = 'GITLAB_' + host.replace('.', '_').replace('-', '_').upper() + '_TOKEN'
             token = os.getenv(env_name)
-            if token is None or '' == token:
+            if (token is None or '' == token) and not self.cache.offline and not get_transport().replaying:
                 print('You need to set ' + env_name + ' using environment variables')
                 return package
 
             def get_gitlab_project(host, project):
-                gitlab = Gitlab('https://' + host, token, api_version=4)
+                gitlab = Gitlab('https://' + host, token, api_version=4, session=get_http_session())
                 repo = gitlab.projects.get(project, statistics=True)
                 return dict(
                     git=repo.http_url_to_repo,
@@ -9,6 +9,7 @@ from dotmap import DotMap
 
 from conan_inquiry.transformers.base import BaseTransformer, BaseHTTPTransformer
 from conan_inquiry.util.general import render_readme
+from conan_inquiry.util.http import conditional_get
 
 
 class LicenseDetectorTransformer(BaseHTTPTransformer):
@@ -16,6 +17,9 @@ class LicenseDetectorTransformer(BaseHTTPTransformer):
     If the license is a link, try to replace it by the license ID it represents
     """
 
+    reads = {'license', '_license_data'}
+    writes = {'license', '_license_data'}
+
     whitespace_re = re.compile(r'\w')
     replaceable_re = re.compile(r'<[^>]*>')
     # from http://emailregex.com/
@@ -24,8 +28,11 @@ class LicenseDetectorTransformer(BaseHTTPTransformer):
     year_re = re.compile(r'\b(19|20)\d\d([\d,\- ]+(19|20)\d\d)?\b')
 
     def __init__(self):
-        # prepare data
         super().__init__()
+        self.licenses = dict()
+        self.license_keys = set()
+
+    def prepare(self):
         directory = os.path.dirname(os.path.realpath(__file__))
         self.licenses = {self._prepare_license(os.path.join(directory, f)): f.replace('.txt', '')
                          for f in os.listdir(directory)
@@ -74,6 +81,9 @@ class LicenseDetectorTransformer(BaseHTTPTransformer):
 
 
 class AuthorCombinerTransformer(BaseTransformer):
+    reads = {'authors'}
+    writes = {'authors', 'author'}
+
     def transform(self, package):
         if 'authors' not in package:
             package.authors = []
@@ -82,11 +92,13 @@ class AuthorCombinerTransformer(BaseTransformer):
 
 
 class ShortDescriptionTransformer(BaseTransformer):
+    reads = {'short_description', 'description'}
+    writes = {'short_description', 'description'}
+
     tag_re = re.compile(r'<[/a-z][^>]*>')
     url_re = re.compile(r'https?://\S+')
 
-    @classmethod
-    def prepare(cls):
+    def prepare(self):
         if not nltk.downloader._downloader.is_installed('punkt'):
             nltk.download('punkt')
 
@@ -108,6 +120,9 @@ class ShortDescriptionTransformer(BaseTransformer):
 
 
 class KeywordDuplicateEliminator(BaseTransformer):
+    reads = {'keywords'}
+    writes = {'keywords'}
+
     def transform(self, package):
         if 'keywords' in package:
             package.keywords = list(set(package.keywords))
@@ -115,20 +130,28 @@ class KeywordDuplicateEliminator(BaseTransformer):
 
 
 class ReadmeFetcher(BaseHTTPTransformer):
+    reads = {'urls.readme'}
+    writes = {'files.readme'}
+
     def transform(self, package):
         if 'readme' in package.urls and 'readme' not in package.files:
             package.files.readme = dict(
                 url=package.urls.readme,
-                content=self.cache.get(package.urls.readme, timedelta(days=2),
-                                       'rendered_readme',
-                                       lambda: render_readme(package.urls.readme,
-                                                             self.http.get(package.urls.readme).text,
-                                                             '/'.join(package.urls.readme.split('/')[:-1])))
+                content=self.cache.get_conditional(
+                    package.urls.readme, timedelta(days=2), 'rendered_readme',
+                    lambda validators: conditional_get(
+                        package.urls.readme, validators,
+                        lambda response: render_readme(package.urls.readme, response.text,
+                                                       '/'.join(package.urls.readme.split('/')[:-1])),
+                        http=self.http))
             )
         return package
 
 
 class CategoriesTransformer(BaseTransformer):
+    reads = {'categories'}
+    writes = {'categories'}
+
     VALID_PREFIX = [
         'topic.library',
         'topic.tool',
@@ -157,6 +180,9 @@ class CategoriesTransformer(BaseTransformer):
 
 
 class OfficiallityTransformer(BaseTransformer):
+    reads = {'recipies', 'urls.github'}
+    writes = {'recipies', 'officiallity'}
+
     def _transform_recipe(self, package, rec):
         if 'repo' not in rec or 'bintray' not in rec.repo:
             return rec
@@ -223,6 +249,9 @@ class RemoveTemporariesTransformer(BaseTransformer):
 
 
 class AddEmptyTransformer(BaseTransformer):
+    reads = set()
+    writes = {'keywords', 'categories', 'authors'}
+
     def transform(self, package):
         self._set_unless_exists(package, 'keywords', [])
         self._set_unless_exists(package, 'categories', [])
@@ -4,11 +4,12 @@ import os
 from datetime import timedelta
 from json import JSONDecodeError
 
-from requests import Session
 from requests.auth import HTTPBasicAuth
 
-from conan_inquiry.util.cache import Cache
+from conan_inquiry.util.cache import Cache, Validated, NOT_MODIFIED
+from conan_inquiry.util.fixtures import get_transport
 from conan_inquiry.util.general import AtomicCounter
+from conan_inquiry.util.http import get_http_session, conditional_headers, response_validators
 
 
 class BintrayRateLimitExceeded(Exception):
@@ -24,20 +25,22 @@ class Bintray:
 
     def __init__(self):
         self.auth = HTTPBasicAuth(os.getenv('BINTRAY_USERNAME'), os.getenv('BINTRAY_API_KEY'))
-        if not self.auth.username or not self.auth.password:
+        offline = Cache.current_cache is not None and Cache.current_cache.offline
+        if (not self.auth.username or not self.auth.password) and not offline and not get_transport().replaying:
             raise KeyError('Missing BINTRAY_USERNAME or BINTRAY_API_KEY environment variable')
-        self.http = Session()
+        self.http = get_http_session()
         self.rate = dict(limit=None, remaining=None)
 
     @property
     def rate_used(self):
         return self._rate_used.value
 
-    def _get(self, path):
+    def _get(self, path, validators=None):
         if self._rate_exceeded:
             raise BintrayRateLimitExceeded()
 
-        response = self.http.get('https://api.bintray.com/api/v1' + path, auth=self.auth)
+        response = self.http.get('https://api.bintray.com/api/v1' + path, auth=self.auth,
+                                 headers=conditional_headers(validators))
         if 'x-ratelimit-limit' in response.headers:
             self.rate['limit'] = response.headers['x-ratelimit-limit']
             self.rate['remaining'] = response.headers['x-ratelimit-remaining']
@@ -50,6 +53,9 @@ class Bintray:
 
         self._rate_used.increment()
 
+        if response.status_code == 304:
+            return NOT_MODIFIED
+
         if response.status_code == 404 or ('message' in response.json() and 'was not found' in response.json()['message']):
             raise FileNotFoundError(path)
 
@@ -60,9 +66,14 @@ class Bintray:
 
     def get(self, path, maxage=timedelta(days=28)):
         """Issue a GET request to the Bintray API and return the parsed reponse"""
-        res = Cache.current_cache.get(path, maxage, 'bintray',
-                                      lambda: self._get(path),
-                                      locked_getter=False)
+
+        def getter(validators):
+            res = self._get(path, validators)
+            if res is NOT_MODIFIED:
+                return res
+            return Validated(res, response_validators(res[2]))
+
+        res = Cache.current_cache.get_conditional(path, maxage, 'bintray', getter, locked_getter=False)
         if res[0] == 404 or ('message' in res[1] and 'was not found' in res[1]['message']):
             raise FileNotFoundError()
         return res[1]
@@ -0,0 +1,104 @@
+"""Content-addressed storage for large strings"""
+
+import gzip
+import hashlib
+import os
+from tempfile import NamedTemporaryFile
+from typing import Set
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BlobStore:
+    """
+    Stores strings in files named by the SHA-256 of their content, so that identical content is only stored once
+
+    Blobs can optionally be compressed using gzip or, if the zstandard module is available, zstd.
+    """
+
+    _suffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, directory: str, compression: str = None):
+        if compression not in self._suffixes:
+            raise ValueError('Invalid compression {}, choose between gzip and zstd'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard module')
+        self.directory = directory
+        self.compression = compression
+
+    @classmethod
+    def default_compression(cls):
+        return 'zstd' if zstandard is not None else 'gzip'
+
+    @classmethod
+    def digest(cls, text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, digest: str, compression: str) -> str:
+        return os.path.join(self.directory, digest + self._suffixes[compression])
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == 'gzip':
+            return gzip.compress(data)
+        elif self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    def put(self, text: str) -> str:
+        """Store a string, unless it already exists, and return its digest"""
+
+        digest = self.digest(text)
+        path = self._path(digest, self.compression)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            # write to a temporary file first so that a blob is either complete or does not exist
+            with NamedTemporaryFile(dir=self.directory, delete=False) as f:
+                f.write(self._compress(text.encode('utf-8')))
+            os.replace(f.name, path)
+        return digest
+
+    def get(self, digest: str) -> str:
+        """Load the string with the given digest, regardless of how it was compressed"""
+
+        for compression in self._suffixes:
+            path = self._path(digest, compression)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if compression == 'gzip':
+                    data = gzip.decompress(data)
+                elif compression == 'zstd':
+                    if zstandard is None:
+                        raise ValueError('Blob {} is compressed using zstd, which requires the zstandard module'
+                                         .format(digest))
+                    data = zstandard.ZstdDecompressor().decompress(data)
+                return data.decode('utf-8')
+        raise FileNotFoundError('Missing blob {}'.format(digest))
+
+    def remove(self, digest: str):
+        """Delete a blob, regardless of how it was compressed"""
+
+        for compression in self._suffixes:
+            path = self._path(digest, compression)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def remove_unreferenced(self, referenced: Set[str]) -> int:
+        """Delete all blobs that are not in the given set of digests, returns the number of deleted blobs"""
+
+        if not os.path.isdir(self.directory):
+            return 0
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.split('.')[0] not in referenced:
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+        return removed
+
+    def size(self) -> int:
+        if not os.path.isdir(self.directory):
+            return 0
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
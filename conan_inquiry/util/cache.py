@@ -1,118 +1,758 @@
+import gzip
+import logging
 import os
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from json import JSONDecodeError, dump as json_dump, load as json_load
-from threading import Lock
-from typing import Callable, Union, Dict, Any, List
+from json import JSONDecodeError, dumps as json_dumps, loads as json_loads, load as json_load
+from tempfile import NamedTemporaryFile
+from contextlib import contextmanager
+from threading import Lock, BoundedSemaphore, Event, Thread, local
+from typing import Callable, Union, Dict, Any, List, Tuple, Set, Optional
+
+from conan_inquiry.util.blobs import BlobStore
+from conan_inquiry.util.general import AtomicCounter
+
+
+class OfflineCacheMiss(Exception):
+    def __init__(self, key, context, *args):
+        super().__init__('No cached value for {} in {} while offline'.format(key, context), *args)
+
+
+class Validated:
+    """A value returned by a conditional getter together with the validators (ETag, Last-Modified) it came with"""
+
+    def __init__(self, value, validators: Dict[str, str] = None):
+        self.value = value
+        self.validators = validators or None
+
+
+# returned by a conditional getter if the server answered 304 Not Modified
+NOT_MODIFIED = object()
+
+
+class CacheStats:
+    """Counters describing how a single context of the cache has been used"""
+
+    # lookups of valid entries, of missing entries, of expired entries and of expired entries that were returned anyway
+    # (with max_staleness), lookups that waited for another thread, bytes read from and written to disk, number of
+    # calls to getters and the number of seconds spent in them, and revalidations that were answered with not modified
+    fields = ['hits', 'misses', 'expired', 'stale', 'coalesced', 'bytes_read', 'bytes_written', 'fetches',
+              'fetch_time', 'not_modified']
+
+    def __init__(self):
+        self.counters = {field: AtomicCounter(0) for field in self.fields}
+
+    def increment(self, field: str, by=1):
+        self.counters[field].increment(by)
+
+    def __getitem__(self, field: str):
+        return self.counters[field].value
+
+    def as_dict(self) -> Dict[str, Union[int, float]]:
+        return {field: counter.value for field, counter in self.counters.items()}
 
 
 class Cache:
-    """This class provides a simple cache with "expiry-on-retrieval"""
+    """
+    This class provides a simple cache with "expiry-on-retrieval"
+
+    Entries are stored in an SQLite database keyed by (context, key), which is memory-mapped. A context is only read
+    from disk once it is first accessed, and each value is only decoded once it is requested. Only entries that have
+    changed since the last save are written back.
+
+    Saving is done by a dedicated writer thread, every save_interval and when the cache is closed, so that no other
+    thread has to wait for disk I/O. The database is in write-ahead-log mode and each save is a single transaction, so
+    an interrupted save never leaves a partially written cache behind, and readers are not blocked by the writer.
+
+    Entries are never modified in place, only replaced, so reading an entry that is already in memory does not need any
+    lock. Computing and storing values is guarded by one of several lock stripes, chosen by context and key, so that
+    unrelated lookups do not wait for each other.
+
+    When several threads miss on the same key at the same time only the first one computes the value (if the getter is
+    not locked the others would otherwise start identical requests), the others wait for its result.
+
+    If max_staleness is given, expired entries that are not older than their maximum age plus max_staleness are
+    returned immediately and refreshed by a small pool of background workers. Older entries are fetched synchronously.
+
+    Contexts can be given a budget in bytes. Whenever the cache is saved and a context exceeds its budget, entries that
+    have expired are evicted first, followed by the least recently used ones.
+
+    Strings longer than blob_threshold (such as READMEs, conanfiles or documentation pages) are not stored in the
+    database but in a compressed, content-addressed blob store next to it, so that identical content is only stored
+    once. Blobs are loaded when the value that references them is decoded.
+
+    Entries can carry validators (ETag, Last-Modified). Values retrieved with get_conditional pass them to the getter
+    once an entry has expired, so that it can issue a conditional request; if the getter reports that the value has
+    not been modified only the time of the entry is updated.
+
+    In offline mode all entries are used regardless of their age, and trying to compute a missing value raises
+    OfflineCacheMiss instead. The whole cache can be exported to and imported from a single compressed snapshot file.
+    """
 
     current_cache = None  # type: Cache
     _global_context = '_'
+    _sqlite_header = b'SQLite format 3\x00'
+    _unloaded = object()
+    _blob_marker = '$blob'
+    _columns = ['context', 'key', 'value', 'time', 'maxage', 'size', 'atime', 'validators']
+    _mmap_size = 1024 * 1024 * 1024
+    _snapshot_format = 'conan_inquiry-cache'
+    _snapshot_version = 1
 
-    def __init__(self, file: str = None, notimeout=False):
+    # contexts that store full documents, everything else is small enough to not need a limit
+    default_budgets = {
+        'github_raw': 64 * 1024 * 1024,
+        'github_readme': 64 * 1024 * 1024,
+        'boost_docs': 64 * 1024 * 1024,
+        'rendered_readme': 64 * 1024 * 1024,
+    }
+
+    def __init__(self, file: str = None, notimeout=False, offline=False, stripes=64,
+                 max_staleness: timedelta = None, refresh_workers=8, refresh_queue=64,
+                 budgets: Dict[str, int] = None, blob_threshold=4096, save_interval=timedelta(minutes=2)):
         self.file = file if file is not None else os.path.join(os.getcwd(), '.cache')
-        self.notimeout = notimeout
-        self.cache = None
+        self.notimeout = notimeout or offline
+        self.offline = offline
+        self.max_staleness = max_staleness
+        self.budgets = budgets if budgets is not None else self.default_budgets
+        self.blob_threshold = blob_threshold
+        self.save_interval = save_interval
+        self.blobs = BlobStore(self.file + '.blobs', BlobStore.default_compression())
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache = None  # type: Dict[str, Dict[str, Dict[str, Any]]]
+        self._loaded = set()
+        # protects the set of dirty entries
         self.lock = Lock()
-        self._last_save = None
+        # protect the database connections used for reading and writing
+        self._db_lock = Lock()
+        self._write_lock = Lock()
+        self._stripes = [Lock() for _ in range(stripes)]
+        self._inflight = dict()  # type: Dict[Tuple[str, str], Future]
+        self.stats = dict()  # type: Dict[str, CacheStats]
+        self._refresh_workers = refresh_workers
+        # limits the number of refreshes that are queued or running, further stale entries are just returned
+        self._refresh_slots = BoundedSemaphore(refresh_queue)
+        self._refresher = None  # type: ThreadPoolExecutor
+        self._db = None  # type: sqlite3.Connection
+        self._writer_db = None  # type: sqlite3.Connection
+        self._dirty = None
+        self._accessed = None
+        self._writer = None  # type: Thread
+        self._save_requested = Event()
+        self._closing = Event()
+        self._tracking = local()
+
+    def _open_db(self):
+        legacy = None
+        if os.path.exists(self.file):
+            with open(self.file, 'rb') as f:
+                is_sqlite = f.read(len(self._sqlite_header)) == self._sqlite_header
+            if not is_sqlite and os.path.getsize(self.file) > 0:
+                # caches used to be a single JSON file, import it once and keep the original next to the new one
+                try:
+                    legacy = json_load(open(self.file, 'r'))
+                except (JSONDecodeError, UnicodeDecodeError):
+                    legacy = dict()
+                os.replace(self.file, self.file + '.json')
+            elif not is_sqlite:
+                os.remove(self.file)
+        else:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+
+        try:
+            self._writer_db = self._create_schema()
+        except sqlite3.DatabaseError as e:
+            # do not silently throw away a damaged cache, it might still be possible to recover parts of it
+            print('Unable to open cache {} ({}), moving it to {}.corrupt and starting with an empty cache'.format(
+                self.file, e, self.file))
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(self.file + suffix):
+                    os.replace(self.file + suffix, self.file + '.corrupt' + suffix)
+            self._writer_db = self._create_schema()
+        if legacy is not None:
+            with self._writer_db:
+                self._writer_db.executemany(self._upsert_sql,
+                                            (self._row(context, key, entry)
+                                             for context, entries in legacy.items()
+                                             for key, entry in entries.items()))
+        self._db = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.file, check_same_thread=False)
+        db.execute('PRAGMA mmap_size = {}'.format(self._mmap_size))
+        return db
+
+    def _create_schema(self) -> sqlite3.Connection:
+        db = self._connect()
+        try:
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                       'context TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, time REAL NOT NULL, '
+                       'maxage REAL, size INTEGER NOT NULL DEFAULT 0, atime REAL NOT NULL DEFAULT 0, '
+                       'validators TEXT, PRIMARY KEY (context, key))')
+            columns = [row[1] for row in db.execute('PRAGMA table_info(cache)')]
+            if 'maxage' not in columns:
+                db.execute('ALTER TABLE cache ADD COLUMN maxage REAL')
+                db.execute('ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+                db.execute('ALTER TABLE cache ADD COLUMN atime REAL NOT NULL DEFAULT 0')
+                db.execute('UPDATE cache SET size = length(value), atime = time')
+            if 'validators' not in columns:
+                db.execute('ALTER TABLE cache ADD COLUMN validators TEXT')
+            db.commit()
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db
+
+    _upsert_sql = 'INSERT OR REPLACE INTO cache ({}) VALUES ({})'.format(', '.join(_columns),
+                                                                         ', '.join('?' * len(_columns)))
+
+    def _externalize(self, value, sizes: List[int]):
+        """Replace all large strings in the value by references to blobs"""
+
+        if isinstance(value, str) and len(value) > self.blob_threshold:
+            sizes.append(len(value))
+            return {self._blob_marker: self.blobs.put(value)}
+        elif isinstance(value, dict):
+            return {k: self._externalize(v, sizes) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [self._externalize(v, sizes) for v in value]
+        return value
+
+    def _internalize(self, value, sizes: List[int]):
+        """Replace all blob references in the value by their content"""
+
+        if isinstance(value, dict):
+            if len(value) == 1 and self._blob_marker in value:
+                blob = self.blobs.get(value[self._blob_marker])
+                sizes.append(len(blob))
+                return blob
+            return {k: self._internalize(v, sizes) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [self._internalize(v, sizes) for v in value]
+        return value
+
+    @classmethod
+    def _references(cls, value):
+        if isinstance(value, dict):
+            if len(value) == 1 and cls._blob_marker in value:
+                yield value[cls._blob_marker]
+            else:
+                for v in value.values():
+                    yield from cls._references(v)
+        elif isinstance(value, list):
+            for v in value:
+                yield from cls._references(v)
+
+    def _row(self, context: str, key: str, entry: Dict[str, Any]):
+        # the size includes externalized strings so that budgets also limit the blob store, evicting an entry deletes
+        # its blobs
+        sizes = []
+        value = json_dumps(self._externalize(entry['value'], sizes))
+        validators = entry.get('validators')
+        return (context, key, value, entry['time'], entry.get('maxage'), len(value.encode('utf-8')) + sum(sizes),
+                datetime.now().timestamp(), json_dumps(validators) if validators else None)
+
+    def _referenced_blobs(self) -> Set[str]:
+        """The digests of all blobs used by stored entries. The write lock needs to be held by the caller."""
+
+        return set(digest
+                   for row in self._writer_db.execute('SELECT value FROM cache WHERE value LIKE ?',
+                                                      ('%' + json_dumps(self._blob_marker) + '%',))
+                   for digest in self._references(json_loads(row[0])))
+
+    def _evict(self, context: str) -> int:
+        """
+        Delete entries until the context fits into its budget, returns the number of deleted entries. The write lock
+        needs to be held by the caller.
+        """
+
+        budget = self.budgets.get(context)
+        if budget is None:
+            return 0
+        total = self._writer_db.execute('SELECT COALESCE(SUM(size), 0) FROM cache WHERE context = ?',
+                                        (context,)).fetchone()[0]
+        if total <= budget:
+            return 0
+
+        evicted = []
+        now = datetime.now().timestamp()
+        # expired entries first, then the least recently used ones
+        rows = self._writer_db.execute('SELECT key, size FROM cache WHERE context = ? '
+                                       'ORDER BY (maxage IS NOT NULL AND time + maxage < ?) DESC, atime ASC',
+                                       (context, now))
+        for key, size in rows:
+            if total <= budget:
+                break
+            evicted.append(key)
+            total -= size
+        # the entries in memory that match the evicted rows, anything set after this point is kept
+        entries = self.cache.get(context, dict())
+        stored = {key: entries.get(key) for key in evicted}
+        # blobs of the evicted entries, which are deleted as well unless other entries use them too
+        blobs = set(digest
+                    for key in evicted
+                    for row in self._writer_db.execute('SELECT value FROM cache WHERE context = ? AND key = ?',
+                                                       (context, key))
+                    for digest in self._references(json_loads(row[0])))
+        with self._writer_db:
+            self._writer_db.executemany('DELETE FROM cache WHERE context = ? AND key = ?',
+                                        [(context, key) for key in evicted])
+        if blobs:
+            for digest in blobs - self._referenced_blobs():
+                self.blobs.remove(digest)
+        for key in evicted:
+            # set() replaces the entry before marking it dirty, so both are checked under the stripe lock
+            with self._stripe(key, context), self.lock:
+                if (context, key) not in self._dirty and entries.get(key) is stored[key]:
+                    entries.pop(key, None)
+        self.logger.info('Evicted %d entries from %s', len(evicted), context)
+        return len(evicted)
 
     def _save(self):
-        with self.lock:
-            print('Saving cache...')
-            os.makedirs(os.path.dirname(self.file), exist_ok=True)
-            json_dump(self.cache, open(self.file, 'w'))
-            print('Cache saved.')
+        """Write all changed entries to disk"""
+
+        with self._write_lock:
+            with self.lock:
+                dirty, self._dirty = self._dirty, set()
+                accessed, self._accessed = self._accessed, set()
+            if not dirty and not accessed:
+                return
+
+            self.logger.info('Saving cache...')
+            upserts = []
+            deletes = []
+            try:
+                for context, key in dirty:
+                    entry = self.cache[context].get(key, self._unloaded)
+                    if entry is None:
+                        deletes.append((context, key))
+                    elif entry is not self._unloaded:
+                        row = self._row(context, key, entry)
+                        upserts.append(row)
+                now = datetime.now().timestamp()
+                with self._writer_db:
+                    self._writer_db.executemany(self._upsert_sql, upserts)
+                    self._writer_db.executemany('DELETE FROM cache WHERE context = ? AND key = ?', deletes)
+                    self._writer_db.executemany('UPDATE cache SET atime = ? WHERE context = ? AND key = ?',
+                                                [(now, context, key) for context, key in accessed - dirty])
+            except BaseException:
+                # keep the changes, so that the next save (at the latest when the cache is closed) tries again
+                with self.lock:
+                    self._dirty |= dirty
+                    self._accessed |= accessed
+                raise
+            for row in upserts:
+                self._stats(row[0]).increment('bytes_written', row[5])
+            for context in set(row[0] for row in upserts):
+                self._evict(context)
+        self.logger.info('Cache saved (%d changed entries).', len(upserts) + len(deletes))
 
-    def _maybe_save(self):
-        # automatically save every 2 minutes
-        if (datetime.now() - self._last_save) > timedelta(minutes=2):
-            self._save()
+    def _write(self):
+        """Body of the writer thread"""
+
+        while not self._closing.is_set():
+            self._save_requested.wait(self.save_interval.total_seconds())
+            self._save_requested.clear()
+            try:
+                self._save()
+            except Exception:
+                self.logger.exception('Unable to save the cache')
 
     def __enter__(self):
         print('Opening cache...')
-        with self.lock:
+        with self._write_lock, self._db_lock, self.lock:
             self.__class__.current_cache = self
-            if os.path.exists(self.file):
-                try:
-                    self.cache = json_load(open(self.file, 'r'))
-                except JSONDecodeError:
-                    self.cache = dict()
-            else:
-                self.cache = dict()
-            self._last_save = datetime.now()
+            self._open_db()
+            self.cache = dict()
+            self._loaded = set()
+            self._dirty = set()
+            self._accessed = set()
+            self._closing.clear()
+            self._writer = Thread(target=self._write, name='cache-writer', daemon=True)
+            self._writer.start()
+            if self.max_staleness is not None:
+                self._refresher = ThreadPoolExecutor(self._refresh_workers, thread_name_prefix='cache-refresh')
         print('Cache loaded.')
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         print('Closing cache...')
+        if self._refresher is not None:
+            # let queued refreshes finish so that they end up on disk
+            self._refresher.shutdown(wait=True)
+            self._refresher = None
+        self._closing.set()
+        self._save_requested.set()
+        self._writer.join()
         self._save()
+        with self._db_lock, self._write_lock:
+            self._db.close()
+            self._writer_db.close()
         print('Cache closed.')
 
+    def _stats(self, context: str) -> CacheStats:
+        stats = self.stats.get(context)
+        if stats is None:
+            stats = self.stats.setdefault(context, CacheStats())
+        return stats
+
+    def print_stats(self):
+        """Print a table with the usage statistics of all contexts"""
+
+        print('Cache usage:')
+        row = '\t{:<20} {:>8} {:>8} {:>8} {:>8} {:>9} {:>10} {:>10} {:>8} {:>9} {:>12}'
+        print(row.format('Context', 'Hits', 'Misses', 'Expired', 'Stale', 'Coalesced', 'Read KiB', 'Write KiB',
+                         'Fetches', 'Fetch s', 'Not modified'))
+        for context, stats in sorted(self.stats.items()):
+            print(row.format(context, stats['hits'], stats['misses'], stats['expired'], stats['stale'],
+                             stats['coalesced'], stats['bytes_read'] // 1024, stats['bytes_written'] // 1024,
+                             stats['fetches'], '{:.1f}'.format(stats['fetch_time']), stats['not_modified']))
+
+    def _fetch(self, context: str, func: Callable[[], Any]) -> Tuple[Any, Dict[str, str]]:
+        """Run a getter, keeping track of how long it takes, returns the value and its validators"""
+
+        start = time.perf_counter()
+        try:
+            value = func()
+            if isinstance(value, Validated):
+                return self._checked(value.value), value.validators
+            return self._checked(value), None
+        finally:
+            stats = self._stats(context)
+            stats.increment('fetches')
+            stats.increment('fetch_time', time.perf_counter() - start)
+
+    def compact(self):
+        """
+        Remove all expired entries, enforce the budgets and rewrite the file without unused space. Returns the size of
+        the file before and after.
+        """
+
+        self._save()
+        with self._write_lock:
+            before = self._disk_size()
+            with self._writer_db:
+                expired = self._writer_db.execute('DELETE FROM cache WHERE maxage IS NOT NULL AND time + maxage < ?',
+                                                  (datetime.now().timestamp(),)).rowcount
+            evicted = sum(self._evict(context) for context in self.budgets)
+            self._writer_db.execute('VACUUM')
+            blobs = self.blobs.remove_unreferenced(self._referenced_blobs())
+            after = self._disk_size()
+            self.cache = dict()
+            self._loaded = set()
+        print('Removed {} expired and {} evicted entries, and {} unused blobs.'.format(expired, evicted, blobs))
+        return before, after
+
+    def export_snapshot(self, file: str) -> int:
+        """Write all entries and the blobs they reference to a compressed snapshot, returns the number of entries"""
+
+        self._save()
+        directory = os.path.dirname(os.path.abspath(file))
+        count = 0
+        digests = set()
+        # write to a temporary file first so that an existing snapshot is only replaced by a complete one
+        with NamedTemporaryFile(dir=directory, delete=False) as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+            f.write(json_dumps(dict(format=self._snapshot_format, version=self._snapshot_version)) + '\n')
+            with self._write_lock:
+                rows = self._writer_db.execute('SELECT {} FROM cache'.format(', '.join(self._columns))).fetchall()
+            for row in rows:
+                f.write(json_dumps(dict(entry=dict(zip(self._columns, row)))) + '\n')
+                digests.update(self._references(json_loads(row[2])))
+                count += 1
+            for digest in sorted(digests):
+                f.write(json_dumps(dict(blob=digest, content=self.blobs.get(digest))) + '\n')
+        os.replace(raw.name, file)
+        return count
+
+    def import_snapshot(self, file: str) -> int:
+        """Add all entries from a snapshot, replacing existing ones with the same key, returns the number of entries"""
+
+        rows = []
+        with gzip.open(file, 'rt', encoding='utf-8') as f:
+            header = json_loads(f.readline())
+            if header.get('format') != self._snapshot_format or header.get('version') != self._snapshot_version:
+                raise ValueError('{} is not a supported cache snapshot'.format(file))
+            for line in f:
+                item = json_loads(line)
+                if 'blob' in item:
+                    self.blobs.put(item['content'])
+                else:
+                    # snapshots written before a column was added simply lack it
+                    rows.append(tuple(item['entry'].get(column) for column in self._columns))
+        self._save()
+        with self._write_lock:
+            with self._writer_db:
+                self._writer_db.executemany(self._upsert_sql, rows)
+            self.cache = dict()
+            self._loaded = set()
+        return len(rows)
+
+    def _disk_size(self) -> int:
+        """Size of the database and blobs, the write lock needs to be held by the caller"""
+
+        self._writer_db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        wal = self.file + '-wal'
+        return os.path.getsize(self.file) + (os.path.getsize(wal) if os.path.exists(wal) else 0) + self.blobs.size()
+
+    def _stripe(self, key: str, context: str) -> Lock:
+        return self._stripes[hash((context, key)) % len(self._stripes)]
+
+    def _entries(self, context: str):
+        """Return all entries of a context, reading them from disk if the context has not been accessed before"""
+
+        entries = self.cache.get(context)
+        if entries is None:
+            entries = self.cache.setdefault(context, dict())
+        if context not in self._loaded:
+            with self._db_lock:
+                if context not in self._loaded:
+                    rows = self._db.execute('SELECT key, value, time, maxage, validators FROM cache WHERE context = ?',
+                                            (context,))
+                    size = 0
+                    for key, raw, entry_time, maxage, validators in rows:
+                        # entries that have been set in the meantime take precedence
+                        entries.setdefault(key, dict(raw=raw, time=entry_time, maxage=maxage,
+                                                     validators=json_loads(validators) if validators else None))
+                        size += len(raw)
+                    self._stats(context).increment('bytes_read', size)
+                    self._loaded.add(context)
+        return entries
+
+    def _entry(self, key: str, context: str):
+        return self._entries(context).get(key)
+
+    def _value(self, key: str, context: str, entry: Dict[str, Any]):
+        """Return the value of an entry, decoding it if needed"""
+
+        if 'value' in entry:
+            return entry['value']
+        sizes = []
+        value = self._internalize(json_loads(entry['raw']), sizes)
+        self._stats(context).increment('bytes_read', sum(sizes))
+        entries = self.cache[context]
+        # replace the entry unless it has changed while decoding
+        if entries.get(key) is entry:
+            entries[key] = dict(value=value, time=entry['time'], maxage=entry['maxage'],
+                                validators=entry.get('validators'))
+        return value
+
+    def _mark_dirty(self, key: str, context: str):
+        with self.lock:
+            self._dirty.add((context, key))
+
     def remove(self, key, context):
         if context is None:
             self.remove(key, self._global_context)
         else:
-            with self.lock:
-                del self.cache[context][key]
+            with self._stripe(key, context):
+                if self._entry(key, context) is None:
+                    raise KeyError(key)
+                self.cache[context][key] = None
+            self._mark_dirty(key, context)
 
-        self._maybe_save()
+    def _set(self, key: str, value: Union[str, int, float, Dict[str, Any]], context: str = None,
+             maxage: timedelta = None, validators: Dict[str, str] = None):
+        """Store a value, the stripe lock for the key needs to be held by the caller"""
 
-    def _set(self, key: str, value: Union[str, int, float, Dict[str, Any]], context: str = None):
         if context is None:
-            self._set(key, value, self._global_context)
+            self._set(key, value, self._global_context, maxage, validators)
         else:
-            if context not in self.cache:
-                self.cache[context] = dict()
-            self.cache[context][key] = dict(value=value, time=datetime.now().timestamp())
-
-        self._maybe_save()
+            self.cache.setdefault(context, dict())[key] = dict(
+                value=value, time=datetime.now().timestamp(),
+                maxage=maxage.total_seconds() if maxage is not None else None, validators=validators)
+            self._mark_dirty(key, context)
 
     def set(self, key: str, value: Union[str, int, float, List[Any], Dict[str, Any]], context: str = None):
         """Insert or update a value"""
 
-        with self.lock:
+        if context is None:
+            context = self._global_context
+        with self._stripe(key, context):
             self._set(key, value, context)
 
+    @classmethod
+    def _merge_version(cls, keys: Dict[Tuple[str, str], Optional[float]], item: Tuple[str, str],
+                       version: Optional[float]):
+        # if an entry was retrieved several times the oldest version counts, no entry at all being the oldest
+        if item in keys and (keys[item] is None or version is not None and keys[item] < version):
+            return
+        keys[item] = version
+
+    @contextmanager
+    def track(self):
+        """
+        Collect the (context, key) of every value the current thread retrieves while in this context, together with
+        the time the retrieved entry has been stored at (None if there was none)
+        """
+
+        previous = getattr(self._tracking, 'keys', None)
+        keys = self._tracking.keys = dict()  # type: Dict[Tuple[str, str], Optional[float]]
+        try:
+            yield keys
+        finally:
+            self._tracking.keys = previous
+            if previous is not None:
+                for item, version in keys.items():
+                    self._merge_version(previous, item, version)
+
+    def _track(self, key: str, context: str, entry):
+        tracked = getattr(self._tracking, 'keys', None)
+        if tracked is not None:
+            self._merge_version(tracked, (context, key), entry['time'] if entry is not None else None)
+
+    def version(self, key: str, context: str = None) -> Optional[Tuple[float, Optional[float]]]:
+        """The time an entry has been stored at and its maximum age in seconds, None if there is no such entry"""
+
+        entry = self._entry(key, context if context is not None else self._global_context)
+        if entry is None:
+            return None
+        return entry['time'], entry['maxage']
+
+    def _valid(self, entry, maxage: timedelta) -> bool:
+        if entry is None:
+            return False
+        return (datetime.now() - maxage) < datetime.fromtimestamp(entry['time']) or self.notimeout
+
     def _has(self, key: str, maxage: timedelta, context: str = None) -> bool:
         if context is None:
             return self._has(key, maxage, self._global_context)
-        else:
-            if context not in self.cache or key not in self.cache[context]:
-                return False
-            time = self.cache[context][key]['time']
-        return (datetime.now() - maxage) < datetime.fromtimestamp(time) or self.notimeout
+        return self._valid(self._entry(key, context), maxage)
 
     def has(self, key: str, maxage: timedelta, context: str = None) -> bool:
         """Check if we have a not-yet-expired value"""
 
-        with self.lock:
-            return self._has(key, maxage, context)
+        return self._has(key, maxage, context)
 
     def get(self, key: str, maxage: timedelta, context: str = None,
             func: Callable[[], Union[str, int, float, List[Any], Dict[str, Any]]] = None,
             locked_getter=True):
         """Retrieve, if possible, a value. Optionally compute and set it if not available"""
 
-        with self.lock:
-            if not self._has(key, maxage, context):
-                if func is None:
-                    return None
+        if context is None:
+            context = self._global_context
+
+        entry = self._entry(key, context)
+        self._accessed.add((context, key))
+        stats = self._stats(context)
+        if self._valid(entry, maxage):
+            stats.increment('hits')
+            self._track(key, context, entry)
+            return self._value(key, context, entry)
+        stats.increment('misses' if entry is None else 'expired')
+        if func is None:
+            self._track(key, context, None)
+            return None
+        if self.offline:
+            raise OfflineCacheMiss(key, context)
+        if self.max_staleness is not None and self._valid(entry, maxage + self.max_staleness):
+            stats.increment('stale')
+            self._refresh(key, context, func, maxage)
+            # the stale entry is what is used, not the one the refresh stores
+            self._track(key, context, entry)
+            return self._value(key, context, entry)
+
+        stripe = self._stripe(key, context)
+        if locked_getter:
+            with stripe:
+                # someone else might have computed the value while we were waiting for the lock
+                entry = self._entry(key, context)
+                if self._valid(entry, maxage):
+                    stats.increment('coalesced')
+                    self._track(key, context, entry)
+                    return self._value(key, context, entry)
+                value, validators = self._fetch(context, func)
+                self._set(key, value, context, maxage, validators)
+                self._track(key, context, self._entry(key, context))
+        else:
+            with stripe:
+                entry = self._entry(key, context)
+                if self._valid(entry, maxage):
+                    stats.increment('coalesced')
+                    self._track(key, context, entry)
+                    return self._value(key, context, entry)
+                future = self._inflight.get((context, key))
+                if future is None:
+                    future = self._inflight[(context, key)] = Future()
+                    owner = True
                 else:
-                    try:
-                        if not locked_getter:
-                            self.lock.release()
-                        value = func()
-
-                        if not isinstance(value, str) and not isinstance(value, int) and not isinstance(value, float) and not isinstance(value, list) and not isinstance(value, dict):
-                            raise TypeError('Invalid type')
-
-                        self._set(key, value, context)
-                        return value
-                    finally:
-                        if not locked_getter:
-                            self.lock.acquire()
-            elif context is None:
-                return self.cache[self._global_context][key]['value']
-            else:
-                return self.cache[context][key]['value']
+                    owner = False
+
+            if not owner:
+                stats.increment('coalesced')
+                value = future.result()
+                self._track(key, context, self._entry(key, context))
+                return value
+
+            try:
+                value, validators = self._fetch(context, func)
+            except BaseException as e:
+                with stripe:
+                    del self._inflight[(context, key)]
+                future.set_exception(e)
+                raise
+            with stripe:
+                self._set(key, value, context, maxage, validators)
+                self._track(key, context, self._entry(key, context))
+                del self._inflight[(context, key)]
+            future.set_result(value)
+        return value
+
+    def get_conditional(self, key: str, maxage: timedelta, context: str = None,
+                        func: Callable[[Dict[str, str]], Union[Validated, Any]] = None, locked_getter=True):
+        """
+        Like get, but the getter receives the validators of the expired entry (or None) and returns either a Validated
+        value or NOT_MODIFIED, in which case the expired value is kept and its time is updated
+        """
+
+        if context is None:
+            context = self._global_context
+        if func is None:
+            return self.get(key, maxage, context)
+
+        def getter():
+            entry = self._entry(key, context)
+            validators = entry.get('validators') if entry is not None else None
+            result = func(validators)
+            if result is NOT_MODIFIED:
+                if entry is None:
+                    raise ValueError('Got not modified for {} in {} without a cached value'.format(key, context))
+                self._stats(context).increment('not_modified')
+                return Validated(self._value(key, context, entry), validators)
+            return result
+
+        return self.get(key, maxage, context, getter, locked_getter)
+
+    def _refresh(self, key: str, context: str, func: Callable[[], Any], maxage: timedelta):
+        """Queue a background refresh of the given entry unless one is already running or the queue is full"""
+
+        with self._stripe(key, context):
+            if (context, key) in self._inflight or not self._refresh_slots.acquire(blocking=False):
+                return
+            future = self._inflight[(context, key)] = Future()
+        self._refresher.submit(self._run_refresh, key, context, func, maxage, future)
+
+    def _run_refresh(self, key: str, context: str, func: Callable[[], Any], maxage: timedelta, future: Future):
+        stripe = self._stripe(key, context)
+        try:
+            value, validators = self._fetch(context, func)
+        except Exception as e:
+            self.logger.warning('Unable to refresh %s in %s: %s', key, context, e)
+            with stripe:
+                del self._inflight[(context, key)]
+            future.set_exception(e)
+            return
+        finally:
+            self._refresh_slots.release()
+        with stripe:
+            self._set(key, value, context, maxage, validators)
+            del self._inflight[(context, key)]
+        future.set_result(value)
+
+    @classmethod
+    def _checked(cls, value):
+        if not isinstance(value, str) and not isinstance(value, int) and not isinstance(value, float) and not isinstance(value, list) and not isinstance(value, dict):
+            raise TypeError('Invalid type')
+        return value
@@ -0,0 +1,180 @@
+"""Recording of all HTTP exchanges of a run, and replaying them later on without any network access"""
+
+import gzip
+import hashlib
+import json
+import os
+import time
+from base64 import b64encode, b64decode
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Dict, List, Any, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from conan_inquiry.util import http
+from conan_inquiry.util.http import ResilientAdapter
+
+
+class FixtureMissing(Exception):
+    def __init__(self, method, url, *args):
+        super().__init__('No recorded response for {} {}'.format(method, url), *args)
+
+
+class FixtureArchive:
+    """
+    Responses to requests, stored in a compressed file of JSON lines
+
+    Requests are identified by their method, URL, body and conditional headers. Responses to identical requests are
+    kept in the order they were recorded and served in that order, repeating the last one once all have been served.
+    """
+
+    _format = 'conan_inquiry-fixtures'
+    _version = 1
+    # request headers that change the response, everything else (such as credentials) is ignored
+    _key_headers = ['if-none-match', 'if-modified-since']
+
+    def __init__(self):
+        self.exchanges = dict()  # type: Dict[str, List[Dict[str, Any]]]
+        self._served = dict()  # type: Dict[str, int]
+        self._lock = Lock()
+
+    @classmethod
+    def key(cls, method: str, url: str, body: Optional[bytes] = None, headers: Dict[str, str] = None) -> str:
+        headers = {name.lower(): value for name, value in (headers or dict()).items()}
+        raw = json.dumps([method.upper(), url, hashlib.sha256(body or b'').hexdigest(),
+                          [headers.get(name) for name in cls._key_headers]])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def record(self, key: str, status: int, headers: Dict[str, str], content: bytes):
+        with self._lock:
+            self.exchanges.setdefault(key, []).append(dict(status=status, headers=dict(headers),
+                                                           content=b64encode(content).decode('ascii')))
+
+    def lookup(self, *keys: str) -> Optional[Dict[str, Any]]:
+        """The next response for the first of the keys that has been recorded"""
+
+        with self._lock:
+            for key in keys:
+                responses = self.exchanges.get(key)
+                if responses:
+                    index = self._served.get(key, 0)
+                    self._served[key] = index + 1
+                    response = dict(responses[min(index, len(responses) - 1)])
+                    response['content'] = b64decode(response['content'])
+                    return response
+        return None
+
+    def save(self, file: str):
+        directory = os.path.dirname(os.path.abspath(file))
+        # write to a temporary file first so that an existing archive is only replaced by a complete one
+        with NamedTemporaryFile(dir=directory, delete=False) as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(dict(format=self._format, version=self._version)) + '\n')
+            with self._lock:
+                for key, responses in self.exchanges.items():
+                    f.write(json.dumps(dict(key=key, responses=responses)) + '\n')
+        os.replace(raw.name, file)
+
+    @classmethod
+    def load(cls, file: str) -> 'FixtureArchive':
+        archive = cls()
+        with gzip.open(file, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != cls._format or header.get('version') != cls._version:
+                raise ValueError('{} is not a supported fixture archive'.format(file))
+            for line in f:
+                item = json.loads(line)
+                archive.exchanges[item['key']] = item['responses']
+        return archive
+
+
+class Transport:
+    """Where requests end up, the network unless fixtures are recorded or replayed"""
+
+    def __init__(self, archive: FixtureArchive = None, replaying=False, latency=0.0):
+        self.archive = archive
+        self.replaying = replaying
+        # seconds every replayed response is delayed by, to simulate the network
+        self.latency = latency
+
+    @property
+    def recording(self):
+        return self.archive is not None and not self.replaying
+
+    def replay(self, method: str, url: str, body: Optional[bytes] = None, headers: Dict[str, str] = None,
+               delay=True):
+        """The recorded response to a request, conditional requests fall back to unconditional responses"""
+
+        response = self.archive.lookup(self.archive.key(method, url, body, headers),
+                                       self.archive.key(method, url, body))
+        if response is None:
+            raise FixtureMissing(method, url)
+        if delay and self.latency > 0:
+            time.sleep(self.latency)
+        return response
+
+
+_transport = Transport()
+
+
+def get_transport() -> Transport:
+    return _transport
+
+
+def _body(request: requests.PreparedRequest) -> Optional[bytes]:
+    return request.body.encode('utf-8') if isinstance(request.body, str) else request.body
+
+
+class RecordingAdapter(ResilientAdapter):
+    def _transmit(self, request, **kwargs):
+        response = super()._transmit(request, **kwargs)
+        _transport.archive.record(FixtureArchive.key(request.method, request.url, _body(request), request.headers),
+                                  response.status_code, response.headers, response.content)
+        return response
+
+
+class ReplayAdapter(ResilientAdapter):
+    def _transmit(self, request, **kwargs):
+        recorded = _transport.replay(request.method, request.url, _body(request), request.headers)
+        response = requests.Response()
+        response.status_code = recorded['status']
+        response.headers = CaseInsensitiveDict(recorded['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = recorded['content']
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+@contextmanager
+def fixtures(record: str = None, replay: str = None, latency=0.0):
+    """
+    Record all HTTP exchanges to the given file, or replay them from it, while in this context. Does nothing if
+    neither is given.
+    """
+
+    global _transport
+    if record is not None and replay is not None:
+        raise ValueError('Fixtures can either be recorded or replayed, not both')
+    if record is None and replay is None:
+        yield _transport
+        return
+
+    previous = _transport
+    if record is not None:
+        _transport = Transport(FixtureArchive())
+        http.set_adapter_class(RecordingAdapter)
+    else:
+        _transport = Transport(FixtureArchive.load(replay), replaying=True, latency=latency)
+        http.set_adapter_class(ReplayAdapter)
+    try:
+        yield _transport
+    finally:
+        if record is not None:
+            _transport.archive.save(record)
+        _transport = previous
+        http.set_adapter_class(ResilientAdapter)
@@ -1,10 +1,11 @@
 import os
-import re
 from threading import Lock
 
 import yaml
 from docutils.core import publish_parts as rst_publish_parts
 
+from conan_inquiry.util.markdown import render_markdown, absolutize_urls
+
 
 def packages_directory():
     return os.path.join(os.path.dirname(__file__), '..', 'data', 'packages')
@@ -18,24 +19,22 @@ def load_packages():
     return [p for p in packages if 'see' not in p]
 
 
-def render_readme(path, raw_str, absolute_url, github_renderer=None):
-    link_re = re.compile(r'(<a.*? href=")([^"]*)(")')
+def render_readme(path, raw_str, absolute_url, github_renderer=None, src_absolute_url=None):
+    """
+    Render a README to HTML based on its file extension, with relative URLs made absolute using absolute_url, or
+    src_absolute_url for images if given
+    """
 
-    if path.lower().endswith('.md'):
+    if path.lower().endswith('.md') or path.lower().endswith('.markdown'):
         if github_renderer:
             rendered = github_renderer(raw_str)
         else:
-            raise NotImplementedError('add non-github markdown renderer')
+            rendered = render_markdown(raw_str)
     elif path.lower().endswith('.rst'):
         rendered = rst_publish_parts(raw_str, writer_name='html')['html_body']
     else:
         rendered = raw_str
-    # a very naive regex-based approach to make relative urls absolute
-    rendered = link_re.sub(
-        lambda a: a.group(1) + (a.group(2) if '/' in a.group(2) else absolute_url + '/' + a.group(2)) + a.group(3),
-        rendered
-    )
-    return rendered
+    return absolutize_urls(rendered, absolute_url, src_absolute_url)
 
 
 class AtomicCounter:
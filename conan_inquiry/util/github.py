@@ -1,71 +1,293 @@
 """Utility functions related to Github"""
 import hashlib
 import json
+import logging
 import os
+import time
 
-import sys
+from concurrent.futures import Future
 from datetime import timedelta
+from threading import Lock, Event
+from typing import List, Tuple
+from urllib.parse import urlsplit, urlencode
 
-from github import Github
+from github import Github, RateLimitExceededException
 from github.Requester import Requester
-from graphqlclient import GraphQLClient
-from conan_inquiry.util.cache import Cache
+from conan_inquiry.util.cache import Cache, Validated, NOT_MODIFIED
+from conan_inquiry.util.fixtures import get_transport, FixtureArchive, FixtureMissing, Transport
+from conan_inquiry.util.http import get_http_session, conditional_headers, response_validators, ResilientAdapter
+from conan_inquiry.util.ratelimit import get_rate_limits
+from conan_inquiry.util.retry import get_retry_policy
+
+logger = logging.getLogger(__name__)
+
+
+class _UncachedResponse(Exception):
+    """Carries a response that should be passed on to the caller but not be cached"""
+
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
 
 
 class CachingRequester(Requester):
+    """
+    Caches successful GET requests to the Github API and revalidates them using conditional requests once they have
+    expired. Answers of 304 Not Modified do not count against the rate limit.
+
+    All requests are paced by the shared rate limit scheduler and retried according to the shared retry policy.
+    """
+
+    maxage = timedelta(days=1)
+    # always asked for the current state
+    uncached = ['/rate_limit']
+    # do not count against the rate limit, so they are not paced and are still sent once a run has been aborted
+    unpaced = ['/rate_limit']
+
     def __init__(self, wrapped: Requester):
-        #  login_or_token, password, base_url, timeout, client_id, client_secret, user_agent, per_page, api_preview
-        super(CachingRequester, self).__init__(
-            None,
-            None,
-            wrapped._Requester__base_url,
-            wrapped._Requester__timeout,
-            wrapped._Requester__clientId,
-            wrapped._Requester__clientSecret,
-            wrapped._Requester__userAgent,
-            wrapped.per_page,
-            wrapped._Requester__apiPreview
-        )
+        # take over the complete state of the wrapped requester, including its credentials
+        self.__dict__.update(wrapped.__dict__)
 
-    def requestJson(self, verb, url, parameters=None, headers=None, input=None, cnx=None):
-        if Cache.current_cache is None:
+    def _transmit(self, verb, url, parameters, headers, input, cnx):
+        transport = get_transport()
+        if transport.archive is None:
             return super(CachingRequester, self).requestJson(verb, url, parameters, headers, input, cnx)
-        
-        rawkey = verb + url + json.dumps(parameters or dict()) + str(headers or dict()) + (input or '') + (cnx or '')
+
+        fixture_url = url + '?' + urlencode(sorted((parameters or dict()).items()))
+        body = json.dumps(input, sort_keys=True).encode('utf-8') if input is not None else None
+        if transport.replaying:
+            recorded = transport.replay(verb, fixture_url, body, headers)
+            return recorded['status'], recorded['headers'], recorded['content'].decode('utf-8')
+        response = super(CachingRequester, self).requestJson(verb, url, parameters, headers, input, cnx)
+        transport.archive.record(FixtureArchive.key(verb, fixture_url, body, headers),
+                                 response[0], response[1], (response[2] or '').encode('utf-8'))
+        return response
+
+    def _send(self, verb, url, parameters, headers, input, cnx):
+        limit = get_rate_limits()['github']
+        if any(url.endswith(path) for path in self.unpaced):
+            response = self._transmit(verb, url, parameters, headers, input, cnx)
+        else:
+            with limit.request():
+                response = self._transmit(verb, url, parameters, headers, input, cnx)
+        limit.update_from_headers(response[1])
+        return response
+
+    def _request(self, verb, url, parameters, headers, input, cnx):
+        return get_retry_policy().call(urlsplit(self._Requester__base_url).hostname,
+                                       lambda: self._send(verb, url, parameters, headers, input, cnx),
+                                       idempotent=verb in ResilientAdapter.idempotent_methods,
+                                       status=lambda response: response[0],
+                                       headers=lambda response: response[1])
+
+    def requestJson(self, verb, url, parameters=None, headers=None, input=None, cnx=None):
+        if Cache.current_cache is None or verb != 'GET' or input is not None or cnx is not None \
+                or any(url.endswith(path) for path in self.uncached):
+            return self._request(verb, url, parameters, headers, input, cnx)
+
+        rawkey = verb + url + json.dumps(parameters or dict(), sort_keys=True) + \
+            json.dumps(headers or dict(), sort_keys=True)
         key = hashlib.md5(rawkey.encode('utf-8')).hexdigest()
 
-        requester = self
-        def getter():
-            print(url)
-            return super(CachingRequester, requester).requestJson(verb, url, parameters, headers, input, cnx)
+        def getter(validators):
+            logger.debug('GET %s', url)
+            request_headers = dict(headers or dict())
+            request_headers.update(conditional_headers(validators))
+            response = self._request(verb, url, parameters, request_headers, input, cnx)
+            if response[0] == 304:
+                return NOT_MODIFIED
+            if response[0] != 200:
+                raise _UncachedResponse(response)
+            return Validated(list(response), response_validators(response[1]))
 
-        res = Cache.current_cache.get(key, timedelta(days=7), 'github_raw', getter, locked_getter=False)
+        try:
+            res = Cache.current_cache.get_conditional(key, self.maxage, 'github_raw', getter, locked_getter=False)
+        except _UncachedResponse as e:
+            return e.response
         return res[0], res[1], res[2]
 
 
+class GraphQLError(Exception):
+    """Errors reported by the GraphQL API for a query or a single repository in it"""
+
+    def __init__(self, errors, *args):
+        super().__init__('; '.join(error.get('message', str(error)) for error in errors), *args)
+        self.errors = errors
+
+
+class GraphQLClient:
+    """Minimal GraphQL client that uses the shared HTTP session"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.token = None
+
+    def inject_token(self, token):
+        self.token = token
+
+    def execute(self, query, variables=None):
+        """Run a query and return the raw JSON response"""
+
+        headers = {'Accept': 'application/json'}
+        if self.token is not None:
+            headers['Authorization'] = 'bearer ' + self.token
+        response = get_http_session().post(self.endpoint, json=dict(query=query, variables=variables),
+                                           headers=headers)
+        response.raise_for_status()
+        try:
+            # the quota of the GraphQL API is counted in points, which depend on the query
+            rate = response.json()['data']['rateLimit']
+            get_rate_limits()['github_graph'].update(rate['remaining'], cost=rate['cost'])
+        except (ValueError, KeyError, TypeError):
+            pass
+        return response.text
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []  # type: List[Tuple[str, str, Future]]
+        self.full = Event()
+
+
+class GraphQLBatcher:
+    """
+    Collects queries for single repositories from many threads and sends them as one query, in which every repository
+    has its own alias, to save round trips and rate limit points
+
+    The first thread to ask for a repository waits for up to delay seconds for others to join the batch, or until
+    batch_size repositories have been asked for, then sends the query. The result for every repository is returned in
+    the same shape as that of a query for just that repository, with the repository as data.repo.
+    """
+
+    def __init__(self, client: GraphQLClient, fragment: str, fragment_name: str, batch_size=25, delay=0.05):
+        self.client = client
+        self.fragment = fragment
+        self.fragment_name = fragment_name
+        self.batch_size = batch_size
+        self.delay = delay
+        self._lock = Lock()
+        self._batch = _Batch()
+
+    def load(self, owner: str, name: str) -> str:
+        """Return the JSON response for the given repository, blocks until its batch has been sent"""
+
+        future = Future()
+        with self._lock:
+            batch = self._batch
+            batch.items.append((owner, name, future))
+            leader = len(batch.items) == 1
+            if len(batch.items) >= self.batch_size:
+                self._batch = _Batch()
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.delay)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = _Batch()
+            self._execute(batch.items)
+        return future.result()
+
+    def _query(self, count: int) -> str:
+        variables = ', '.join('$owner{0}: String!, $name{0}: String!'.format(i) for i in range(count))
+        repositories = '\n'.join('r{0}: repository(owner: $owner{0}, name: $name{0}) {{ ...{1} }}'.format(
+            i, self.fragment_name) for i in range(count))
+        return 'query Repos({}) {{\n{}\nrateLimit {{ cost remaining }}\n}}\n{}'.format(variables, repositories,
+                                                                                       self.fragment)
+
+    @classmethod
+    def _error(cls, errors) -> Exception:
+        if any(error.get('type') == 'RATE_LIMITED' for error in errors):
+            # handled like the rate limit of the REST API, which aborts the run
+            return RateLimitExceededException(403, errors)
+        return GraphQLError(errors)
+
+    def _replay(self, transport: Transport, items: List[Tuple[str, str, Future]]):
+        if transport.latency > 0:
+            time.sleep(transport.latency)
+        for owner, name, future in items:
+            try:
+                recorded = transport.replay('QUERY', owner + '/' + name, self.fragment.encode('utf-8'), delay=False)
+            except FixtureMissing as e:
+                future.set_exception(e)
+                continue
+            content = recorded['content'].decode('utf-8')
+            if recorded['status'] == 200:
+                future.set_result(content)
+            else:
+                future.set_exception(self._error(json.loads(content)))
+
+    def _record(self, transport: Transport, owner: str, name: str, status: int, content: str):
+        if transport.recording:
+            transport.archive.record(FixtureArchive.key('QUERY', owner + '/' + name, self.fragment.encode('utf-8')),
+                                     status, dict(), content.encode('utf-8'))
+
+    def _execute(self, items: List[Tuple[str, str, Future]]):
+        # the composition of batches differs between runs, so fixtures are recorded for each repository
+        transport = get_transport()
+        if transport.replaying:
+            self._replay(transport, items)
+            return
+
+        variables = dict()
+        for i, (owner, name, _) in enumerate(items):
+            variables['owner' + str(i)] = owner
+            variables['name' + str(i)] = name
+        try:
+            response = json.loads(self.client.execute(self._query(len(items)), variables))
+        except BaseException as e:
+            for _, _, future in items:
+                future.set_exception(e)
+            raise
+        data = response.get('data')
+        errors = response.get('errors') or []
+        general = [error for error in errors if not error.get('path')]
+        if data is None or general:
+            # the query as a whole has failed (rate limit, timeout, ...), which says nothing about the repositories
+            general = general or errors or [dict(message='No data in GraphQL response')]
+            for owner, name, future in items:
+                self._record(transport, owner, name, 502, json.dumps(general))
+                future.set_exception(self._error(general))
+            return
+        for i, (owner, name, future) in enumerate(items):
+            alias = 'r' + str(i)
+            alias_errors = [error for error in errors if error['path'][0] == alias]
+            if any(error.get('type') != 'NOT_FOUND' for error in alias_errors):
+                # raised, so that the cache does not store it
+                self._record(transport, owner, name, 502, json.dumps(alias_errors))
+                future.set_exception(self._error(alias_errors))
+                continue
+            result = dict(data=dict(repo=data.get(alias), rateLimit=data.get('rateLimit')))
+            if alias_errors:
+                result['errors'] = alias_errors
+            result = json.dumps(result)
+            self._record(transport, owner, name, 200, result)
+            future.set_result(result)
+
+
 def get_github_client(version):
     """
     Create a Github client for the given Github API version using credentials provided as
-    environment variables
+    environment variables. Credentials are not needed while replaying fixtures.
     """
 
+    replaying = get_transport().replaying
     if version == 3:
         token = os.getenv('GITHUB_TOKEN')
         client_id = os.getenv('GITHUB_CLIENT_ID')
         client_secret = os.getenv('GITHUB_CLIENT_SECRET')
-        if token is None or token == '':
+        if (token is None or token == '') and not replaying:
             raise Exception('You need to set GITHUB_TOKEN using environment variables')
-        if client_id is None or client_id == '':
+        if (client_id is None or client_id == '') and not replaying:
             raise Exception('You need to set GITHUB_CLIENT_ID using environment variables')
-        if client_secret is None or client_secret == '':
+        if (client_secret is None or client_secret == '') and not replaying:
             raise Exception('You need to set GITHUB_CLIENT_SECRET using environment variables')
 
         gh = Github(login_or_token=token, client_id=client_id, client_secret=client_secret, per_page=100)
-        #gh._Github__requester = CachingRequester(gh._Github__requester)
+        gh._Github__requester = CachingRequester(gh._Github__requester)
         return gh
     elif version == 4:
         github_token = os.getenv('GITHUB_TOKEN')
-        if github_token is None or github_token == '':
+        if (github_token is None or github_token == '') and not replaying:
             raise Exception('You need to set GITHUB_TOKEN using environment variables')
 
         graph = GraphQLClient('https://api.github.com/graphql')
@@ -0,0 +1,115 @@
+"""Process-wide HTTP session shared by everything that talks to the network"""
+
+from threading import Lock
+from typing import Callable, Dict, Mapping, Any
+from urllib.parse import urlsplit
+
+import requests
+from cachecontrol import CacheControlAdapter
+
+from conan_inquiry.util.cache import Validated, NOT_MODIFIED
+from conan_inquiry.util.ratelimit import get_rate_limits
+from conan_inquiry.util.retry import get_retry_policy
+
+# number of hosts for which connections are kept open
+POOL_HOSTS = 32
+# maximum number of concurrent connections to a single host, further requests wait for a free connection
+POOL_CONNECTIONS_PER_HOST = 32
+
+
+class ResilientAdapter(CacheControlAdapter):
+    """
+    Retries requests that failed for transient reasons, fails fast for hosts that are down, paces requests to rate
+    limited APIs and keeps track of their remaining quota
+    """
+
+    idempotent_methods = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+    def _transmit(self, request, **kwargs):
+        """Actually send a request, replaced when fixtures are recorded or replayed"""
+
+        return super().send(request, **kwargs)
+
+    def _send(self, request, **kwargs):
+        limit = get_rate_limits().for_url(request.url)
+        if limit is None:
+            return self._transmit(request, **kwargs)
+        with limit.request():
+            response = self._transmit(request, **kwargs)
+        if not getattr(response, 'from_cache', False):
+            limit.update_from_headers(response.headers)
+        return response
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        # GraphQL queries only read data, mutations are not used
+        idempotent = request.method in self.idempotent_methods or url.path.startswith('/graphql')
+        return get_retry_policy().call(url.hostname, lambda: self._send(request, **kwargs), idempotent)
+
+
+_session = None  # type: requests.Session
+_session_lock = Lock()
+_adapter_class = ResilientAdapter
+
+
+def set_adapter_class(adapter_class):
+    """Use a different adapter for the shared session, which is re-created on its next use"""
+
+    global _session, _adapter_class
+    with _session_lock:
+        _adapter_class = adapter_class
+        _session = None
+
+
+def get_http_session() -> requests.Session:
+    """
+    Return the shared HTTP session, which keeps connections alive, limits the number of connections per host, honors
+    HTTP caching headers, retries transient errors and paces requests to rate limited APIs
+    """
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = _adapter_class(pool_connections=POOL_HOSTS, pool_maxsize=POOL_CONNECTIONS_PER_HOST,
+                                     pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def conditional_headers(validators: Dict[str, str] = None) -> Dict[str, str]:
+    """Request headers that make a request conditional on the resource having changed since it was last retrieved"""
+
+    headers = dict()
+    if validators:
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last-modified' in validators:
+            headers['If-Modified-Since'] = validators['last-modified']
+    return headers
+
+
+def response_validators(headers: Mapping[str, str]) -> Dict[str, str]:
+    """Extract the validators (ETag and Last-Modified) from response headers"""
+
+    headers = {name.lower(): value for name, value in headers.items()}
+    return {name: headers[name] for name in ['etag', 'last-modified'] if name in headers}
+
+
+def conditional_get(url: str, validators: Dict[str, str] = None,
+                    parse: Callable[[requests.Response], Any] = lambda response: response.text,
+                    http: requests.Session = None, **kwargs):
+    """
+    Issue a GET request, conditional on the given validators, for use as a getter with Cache.get_conditional. Returns
+    NOT_MODIFIED if the server answers 304, otherwise the parsed response and its validators
+    """
+
+    headers = dict(kwargs.pop('headers', None) or dict())
+    headers.update(conditional_headers(validators))
+    response = (http or get_http_session()).get(url, headers=headers, **kwargs)
+    if response.status_code == 304:
+        return NOT_MODIFIED
+    # only successful responses can be revalidated later on
+    return Validated(parse(response), response_validators(response.headers) if response.status_code == 200 else None)
@@ -0,0 +1,88 @@
+"""Local rendering of Markdown READMEs"""
+
+import hashlib
+import re
+from collections import OrderedDict
+from threading import Lock
+
+import bleach
+import mistune
+
+# Github flavored markdown, raw HTML (such as badges) is kept and sanitized afterwards
+_markdown = mistune.create_markdown(escape=False, plugins=['strikethrough', 'table', 'url', 'task_lists',
+                                                           'footnotes'])
+
+# what remains of the HTML, similar to what Github allows in READMEs
+ALLOWED_TAGS = set(bleach.sanitizer.ALLOWED_TAGS) | {
+    'p', 'br', 'hr', 'div', 'span', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'img', 'picture', 'source', 'table',
+    'thead', 'tbody', 'tfoot', 'tr', 'th', 'td', 'del', 's', 'strike', 'sup', 'sub', 'kbd', 'dl', 'dt', 'dd',
+    'details', 'summary', 'section', 'input'}
+ALLOWED_ATTRIBUTES = {
+    '*': ['id', 'align', 'title'],
+    'a': ['href', 'name'],
+    'img': ['src', 'alt', 'width', 'height'],
+    'source': ['srcset', 'media'],
+    'code': ['class'],
+    'th': ['colspan', 'rowspan'],
+    'td': ['colspan', 'rowspan'],
+    'input': ['type', 'checked', 'disabled'],
+}
+ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
+
+_memo = OrderedDict()
+_memo_lock = Lock()
+# number of rendered documents that are kept in memory
+MEMO_SIZE = 1024
+
+
+def render_markdown(text: str) -> str:
+    """
+    Render Markdown to HTML. Results are memoized by the SHA-256 of the text, as many READMEs (for example those of
+    the Boost libraries) are rendered several times during a run.
+    """
+
+    digest = hashlib.sha256(text.encode('utf-8')).digest()
+    with _memo_lock:
+        if digest in _memo:
+            _memo.move_to_end(digest)
+            return _memo[digest]
+    html = sanitize_html(_markdown(text))
+    with _memo_lock:
+        _memo[digest] = html
+        if len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return html
+
+
+def sanitize_html(html: str) -> str:
+    """Remove everything from HTML that could run scripts, such as script tags and event handler attributes"""
+
+    return bleach.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, protocols=ALLOWED_PROTOCOLS,
+                        strip=True)
+
+
+_url_attribute_re = re.compile(r'''(<[^>]*?\s(href|src)\s*=\s*)(["'])(.*?)\3''', re.IGNORECASE)
+_absolute_re = re.compile(r'^(?:[a-z][a-z0-9+.-]*:|//|#)', re.IGNORECASE)
+
+
+def absolutize_urls(html: str, base_url: str, src_base_url: str = None) -> str:
+    """
+    Make all relative link and image URLs in a HTML document absolute, in a single pass. Relative URLs, including
+    those starting with a slash, are taken to be relative to base_url, which usually is the root of a repository.
+    Images and other src attributes use src_base_url instead, if given, so that they can point to the raw files.
+    """
+
+    base_url = base_url.rstrip('/')
+    src_base_url = src_base_url.rstrip('/') if src_base_url is not None else base_url
+
+    def replace(match):
+        url = match.group(4)
+        if url == '' or _absolute_re.match(url):
+            return match.group(0)
+        path = url.lstrip('/')
+        if path.startswith('./'):
+            path = path[2:]
+        base = src_base_url if match.group(2).lower() == 'src' else base_url
+        return match.group(1) + match.group(3) + base + '/' + path + match.group(3)
+
+    return _url_attribute_re.sub(replace, html)
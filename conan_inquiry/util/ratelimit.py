@@ -0,0 +1,236 @@
+"""Process-wide pacing of requests to rate limited APIs"""
+
+import logging
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import Condition, Lock
+from typing import Mapping, Optional
+from urllib.parse import urlsplit
+
+
+class QuotaExhausted(Exception):
+    def __init__(self, name, wait, *args):
+        super().__init__('Quota of {} exhausted, it only resets in {:.0f} seconds'.format(name, wait), *args)
+
+
+class RateLimitCancelled(Exception):
+    def __init__(self, name, *args):
+        super().__init__('Waiting for the quota of {} was cancelled'.format(name), *args)
+
+
+class RateLimit:
+    """
+    Token bucket pacing the requests to a single API
+
+    As long as more than the low water mark (a fraction of the quota) remains until the quota resets, requests are only
+    limited to the given concurrency. Below it, tokens are refilled at the rate that spreads the remaining requests
+    (minus a reserve) evenly over the time until the reset, and the number of concurrent requests shrinks
+    proportionally, so that a long run slows down instead of exhausting the quota partway through. Once the quota is
+    exhausted requests wait for the reset, or raise QuotaExhausted if that is more than max_wait seconds away.
+
+    Waiting requests raise RateLimitCancelled once the limit has been cancelled.
+    """
+
+    def __init__(self, name: str, concurrency: int, window: timedelta, reserve=0, low_water=0.1, max_wait=300.0):
+        self.name = name
+        self.concurrency = concurrency
+        # used if the API does not tell when its quota resets
+        self.window = window
+        self.reserve = reserve
+        self.low_water = low_water
+        self.max_wait = max_wait
+        self.limit = None  # type: Optional[int]
+        self.remaining = None  # type: Optional[int]
+        self.reset = None  # type: Optional[float]
+        self._updated = None  # type: Optional[float]
+        # remaining quota at the start of the window, if the API does not tell its limit
+        self._initial = None  # type: Optional[int]
+        # expected cost of the next request, for APIs where requests have different costs
+        self.cost = 1
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._condition = Condition(Lock())
+        self._cancelled = False
+        self._in_flight = 0
+        self._tokens = float(concurrency)
+        self._refilled = time.monotonic()
+
+    def _window_end(self) -> Optional[float]:
+        if self.remaining is None:
+            return None
+        return self.reset if self.reset is not None else self._updated + self.window.total_seconds()
+
+    def _known(self, now: float) -> bool:
+        """Whether the remaining quota of the current window is known"""
+
+        end = self._window_end()
+        return end is not None and end > now
+
+    def _available(self) -> int:
+        return self.remaining - self.reserve
+
+    def _paced(self, now: float) -> bool:
+        capacity = self.limit or self._initial or 0
+        return self._known(now) and self._available() <= self.low_water * capacity
+
+    def _rate(self, now: float) -> float:
+        """Tokens per second while requests are paced"""
+
+        return max(self._available(), 0) / max(self._window_end() - now, 1)
+
+    def _allowed_concurrency(self, now: float) -> int:
+        if not self._paced(now):
+            return self.concurrency
+        capacity = self.limit or self._initial
+        return max(1, min(self.concurrency,
+                          round(self.concurrency * self._available() / max(self.low_water * capacity, 1))))
+
+    def _wait_time(self, cost: int) -> Optional[float]:
+        """
+        Seconds until a request of the given cost may start, None if it has to wait for another request to finish.
+        Takes the tokens if it may start now.
+        """
+
+        wall = time.time()
+        if self._in_flight >= self._allowed_concurrency(wall):
+            return None
+        if not self._known(wall):
+            return 0
+        if self._available() < cost:
+            # quota exhausted, wait for the next window
+            return self._window_end() - wall
+        if self._paced(wall):
+            now = time.monotonic()
+            rate = self._rate(wall)
+            self._tokens = min(float(self.concurrency), self._tokens + (now - self._refilled) * rate)
+            self._refilled = now
+            if self._tokens < cost:
+                return (cost - self._tokens) / rate
+            self._tokens -= cost
+        # estimate until the next response reports the actual quota
+        self.remaining -= cost
+        return 0
+
+    def acquire(self, cost: int = None):
+        """Block until a request may be made"""
+
+        cost = cost if cost is not None else self.cost
+        with self._condition:
+            waited = False
+            while True:
+                if self._cancelled:
+                    raise RateLimitCancelled(self.name)
+                wait = self._wait_time(cost)
+                if wait is None:
+                    # woken up once a request finishes
+                    self._condition.wait()
+                    continue
+                if wait <= 0:
+                    break
+                if wait > self.max_wait:
+                    raise QuotaExhausted(self.name, wait)
+                if not waited and wait > 60:
+                    self.logger.warning('Quota of %s nearly exhausted, waiting %d seconds', self.name, wait)
+                    waited = True
+                self._condition.wait(wait)
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def cancel(self):
+        """Make all waiting and future requests raise RateLimitCancelled"""
+
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    @contextmanager
+    def request(self, cost: int = None):
+        self.acquire(cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def update(self, remaining: int, limit: int = None, reset: float = None, cost: int = None):
+        """Record the quota reported by the API, reset is a UNIX timestamp"""
+
+        with self._condition:
+            now = time.time()
+            end = self._window_end()
+            if end is None or end <= now or reset is not None and reset != self.reset:
+                # a new window has started
+                self.remaining = remaining
+                self._initial = remaining
+                self._updated = now
+            else:
+                # responses can arrive out of order, so only ever decrease within a window
+                self.remaining = min(self.remaining, remaining)
+            if limit is not None:
+                self.limit = limit
+            if reset is not None:
+                self.reset = reset
+            if cost is not None:
+                self.cost = max(cost, 1)
+            self._condition.notify_all()
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """Record the quota from the X-RateLimit-* headers of a response, if present"""
+
+        headers = {name.lower(): value for name, value in headers.items()}
+        if 'x-ratelimit-remaining' not in headers:
+            return
+        try:
+            self.update(int(headers['x-ratelimit-remaining']),
+                        int(headers['x-ratelimit-limit']) if 'x-ratelimit-limit' in headers else None,
+                        float(headers['x-ratelimit-reset']) if 'x-ratelimit-reset' in headers else None)
+        except ValueError:
+            pass
+
+
+class RateLimitScheduler:
+    """One RateLimit for each API that is used, shared by all threads"""
+
+    def __init__(self):
+        self.apis = dict(
+            github=RateLimit('github', 15, timedelta(hours=1), reserve=50),
+            github_graph=RateLimit('github_graph', 15, timedelta(hours=1), reserve=50),
+            bintray=RateLimit('bintray', 8, timedelta(hours=24), reserve=10),
+            travis=RateLimit('travis', 8, timedelta(hours=1)),
+        )
+
+    def cancel(self):
+        for limit in self.apis.values():
+            limit.cancel()
+
+    def __getitem__(self, api: str) -> RateLimit:
+        return self.apis[api]
+
+    def for_url(self, url: str) -> Optional[RateLimit]:
+        """The RateLimit that applies to a URL, None if it does not belong to a rate limited API"""
+
+        parts = urlsplit(url)
+        if parts.hostname == 'api.github.com':
+            return self.apis['github_graph' if parts.path.startswith('/graphql') else 'github']
+        elif parts.hostname == 'api.bintray.com':
+            return self.apis['bintray']
+        elif parts.hostname in ['api.travis-ci.org', 'api.travis-ci.com']:
+            return self.apis['travis']
+        return None
+
+
+_scheduler = None  # type: RateLimitScheduler
+_scheduler_lock = Lock()
+
+
+def get_rate_limits() -> RateLimitScheduler:
+    """Return the shared rate limit scheduler"""
+
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RateLimitScheduler()
+        return _scheduler
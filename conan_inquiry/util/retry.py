@@ -0,0 +1,169 @@
+"""Retrying of transient errors and failing fast on hosts that are down"""
+
+import logging
+import random
+import time
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+from http.client import HTTPException
+from threading import Lock
+from typing import Callable, Any, Mapping, Optional, Dict
+
+import requests
+
+
+class CircuitOpenError(ConnectionError):
+    def __init__(self, host, *args):
+        super().__init__('{} has failed repeatedly, not sending any further requests for now'.format(host), *args)
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures of a host. Once there have been threshold of them the circuit opens and all requests
+    fail immediately until cooldown has passed, after which a single request is let through to probe the host again.
+    """
+
+    def __init__(self, host: str, threshold: int, cooldown: timedelta):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._opened = None  # type: Optional[float]
+        self._probing = False
+        self._lock = Lock()
+
+    def check(self):
+        """Raise CircuitOpenError if no request may be sent to the host right now"""
+
+        with self._lock:
+            if self._opened is None:
+                return
+            if self._probing or time.monotonic() - self._opened < self.cooldown.total_seconds():
+                raise CircuitOpenError(self.host)
+            self._probing = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened = None
+            self._probing = False
+
+    def release_probe(self):
+        """The probe has ended without telling whether the host is up, let the next request probe it instead"""
+
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                if self._opened is None or self._probing:
+                    logging.getLogger(self.__class__.__name__).warning('Circuit for %s opened', self.host)
+                self._opened = time.monotonic()
+                self._probing = False
+
+
+class RetryPolicy:
+    """
+    Retries idempotent requests that failed with a connection error, a timeout or a status that signals a temporary
+    problem, waiting a random (full jitter) exponential backoff or as long as the Retry-After header asks for. Failures
+    are counted by one circuit breaker per host.
+    """
+
+    retry_statuses = {429, 500, 502, 503, 504}
+    # errors of the connection itself, but not those of the request such as an invalid URL or too many redirects
+    transient_errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                        HTTPException)
+
+    def __init__(self, attempts=4, backoff=1.0, max_backoff=30.0, max_retry_after=300.0, breaker_threshold=5,
+                 breaker_cooldown=timedelta(minutes=1)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._breakers = dict()  # type: Dict[str, CircuitBreaker]
+        self._breakers_lock = Lock()
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(host, self.breaker_threshold, self.breaker_cooldown)
+            return breaker
+
+    @classmethod
+    def _retry_after(cls, headers: Mapping[str, str]) -> Optional[float]:
+        value = next((v for k, v in headers.items() if k.lower() == 'retry-after'), None)
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def _delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, host: str, func: Callable[[], Any], idempotent=True,
+             status: Callable[[Any], int] = lambda response: response.status_code,
+             headers: Callable[[Any], Mapping[str, str]] = lambda response: response.headers):
+        """
+        Send a request by calling func, retrying it if needed. The status and headers of the response are extracted
+        using the given functions.
+        """
+
+        breaker = self.breaker(host)
+        attempt = 0
+        while True:
+            breaker.check()
+            try:
+                response = func()
+            except self.transient_errors as e:
+                breaker.failure()
+                if not idempotent or attempt + 1 >= self.attempts:
+                    raise
+                delay = self._delay(attempt)
+                reason = str(e)
+            except BaseException:
+                # e.g. an invalid URL or a cancelled rate limit, which must not keep the circuit open forever
+                breaker.release_probe()
+                raise
+            else:
+                code = status(response)
+                if code >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                retry_after = self._retry_after(headers(response))
+                # Github signals secondary rate limits as 403 with a Retry-After header
+                retryable = code in self.retry_statuses or (code == 403 and retry_after is not None)
+                if not retryable or not idempotent or attempt + 1 >= self.attempts \
+                        or (retry_after is not None and retry_after > self.max_retry_after):
+                    return response
+                delay = retry_after if retry_after is not None else self._delay(attempt)
+                reason = 'status {}'.format(code)
+            self.logger.info('Retrying request to %s in %.1f seconds (%s)', host, delay, reason)
+            time.sleep(delay)
+            attempt += 1
+
+
+_policy = None  # type: RetryPolicy
+_policy_lock = Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """Return the shared retry policy"""
+
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            _policy = RetryPolicy()
+        return _policy
@@ -76,10 +76,10 @@ schema = dict(
                     '^.*$': dict(
                         type='object',
                         properties=dict(
-                            content=dict(type='string'),
+                            blob=dict(type='string', pattern='^[0-9a-f]{64}$'),
                             url=dict(type='string', format='uri')
                         ),
-                        required=['content', 'url']
+                        required=['blob', 'url']
                     )
                 },
                 additionalProperties=False
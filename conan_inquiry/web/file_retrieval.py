@@ -24,8 +24,11 @@ class WebFiles:
         if not self.exists(name):
             return None
 
-        with open(self.full_name(name), 'r') as f:
+        with open(self.full_name(name), 'r', encoding='utf-8') as f:
             result = f.read()
+        # blobs are READMEs, conanfiles etc. which have to be served exactly as they were generated
+        if self.is_blob(name):
+            return result
 
         result = self.replacement_html_re.sub(lambda x: self.get_file(x.group(1)), result)
         result = self.replacement_js_re.sub(lambda x: self.get_file(x.group(1)), result)
@@ -43,11 +46,17 @@ class WebFiles:
 
     def names(self):
         files = ['packages.js', 'packages.json']
+        blobs = self.full_name('blobs/')
+        if os.path.isdir(blobs):
+            files.extend('blobs/' + entry for entry in os.listdir(blobs))
         for entry in os.listdir(self.dir):
             full_name = os.path.join(self.dir, entry)
             if os.path.isfile(full_name) and not entry.startswith('_'):
                 files.append(entry)
         return files
 
+    def is_blob(self, name):
+        return name.startswith('blobs/')
+
     def is_constant(self, name):
-        return name == 'packages.js' or name == 'packages.json'
+        return name == 'packages.js' or name == 'packages.json' or self.is_blob(name)
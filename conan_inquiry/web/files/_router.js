@@ -24,9 +24,7 @@ App.router.on(function() {
         var pkgData = _.find(packages_data, function(pkg) { return pkg.id === params.id; });
         App.package.$.html(App.templates.pkg(pkgData));
         timeago().render(App.package.$.find('.timeago'));
-        App.package.$.find('pre > code').each(function(i, block) {
-            hljs.highlightBlock(block);
-        });
+        App.package.loadFiles();
         var versionSelector = App.package.$.find('.version-selector');
         App.package.updateCurrentVersion(versionSelector);
         versionSelector.on('change input', function(evt) { App.package.updateCurrentVersion(evt.target); });
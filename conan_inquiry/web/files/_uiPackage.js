@@ -7,6 +7,22 @@ App.package.showFile = function(file) {
     $('.nav-link[data-filekey]').removeClass('active');
     $('.nav-link[data-filekey=' + file + ']').addClass('active');
 };
+App.package.loadFiles = function() {
+    // file contents are stored separately from the package data and only loaded when needed
+    App.package.$.find('[data-blob]').each(function(index, element) {
+        var $element = $(element);
+        fetch('blobs/' + $element.attr('data-blob')).then(function(response) {
+            return response.text();
+        }).then(function(text) {
+            if ($element.is('code')) {
+                $element.text(text);
+                hljs.highlightBlock(element);
+            } else {
+                $element.html(text);
+            }
+        });
+    });
+};
 App.package.updateCurrentVersion = function(select) {
     var $select = $(select);
     var pkg = _.find(packages_data, function(p) { return p.name === $select.attr('data-package'); });
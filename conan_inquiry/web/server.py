@@ -20,7 +20,8 @@ class DevelopmentHTTPRequestHandler(BaseHTTPRequestHandler):
     def _head(self):
         if self.files.exists(self._current_name()):
             self.send_response(200)
-            self.send_header('Content-Type', guess_type(self.path)[0])
+            # blobs are named by their digest and have no extension
+            self.send_header('Content-Type', guess_type(self.path)[0] or 'text/plain; charset=utf-8')
         else:
             self.send_response(404)
             self.send_header('Content-Type', 'text/html')